@@ -0,0 +1,330 @@
+'''Microbenchmarks for the opcBridge rendering engine
+Run with: python benchmark.py [benchmark ...]'''
+import os
+import sys
+import time
+import timeit
+import json
+import logging
+import argparse
+import datetime
+import tracemalloc
+import asyncio
+import threading
+import http.client
+import werkzeug.serving
+import numpy as np
+import opc
+import opcBridge
+
+def makeFadeState(pixelCount, seed=0):
+    '''Build a renderer with every pixel fading on one of the curves, the
+    fades started at time 0 and lasting between 0.1 and 4 seconds'''
+    rng = np.random.default_rng(seed)
+    renderer = opcBridge.Renderer(60, pixelCount=pixelCount)
+    renderer.pixels[:] = rng.uniform(0, 255, (pixelCount, 3))
+    renderer.fadeTo(np.arange(pixelCount), rng.uniform(0, 255, (pixelCount, 3)),
+                    rng.uniform(0.1, 4, pixelCount),
+                    rng.integers(0, len(opcBridge.CURVES), pixelCount).astype(np.uint8), now=0)
+    return renderer
+
+def benchFrameStep(sizes=(512, 4096, 32768), repeat=5, number=200):
+    '''Time a single interpolation step for several universe sizes'''
+    print('Frame step (interpolate)')
+    for size in sizes:
+        renderer = makeFadeState(size)
+        def step():
+            #Evaluated before any fade ends, so each run does the same amount of work
+            renderer.interpolate(0.05)
+        best = min(timeit.repeat(step, repeat=repeat, number=number)) / number
+        print('  %6d pixels: %8.1f us/frame' % (size, best * 1e6))
+
+def benchEncode(sizes=(512, 4096, 16384), repeat=5, number=50):
+    '''Compare OPC message encoding for the tuple list path and the numpy path'''
+    print('OPC encode (list path vs numpy path)')
+    client = opc.Client('localhost:7890')
+    for size in sizes:
+        pixels = makeFadeState(size).pixels
+        listPixels = pixels.tolist()
+        old = min(timeit.repeat(lambda: client._encode(listPixels), repeat=repeat, number=number)) / number
+        new = min(timeit.repeat(lambda: client._encode(pixels), repeat=repeat, number=number)) / number
+        print('  %6d pixels: %8.1f us list, %8.1f us numpy (%.0fx)' % (size, old * 1e6, new * 1e6, old / new))
+
+def benchCorrection(sizes=(512, 4096, 32768), repeat=5, number=200):
+    '''Time the output color correction stage, with and without dithering'''
+    print('Color correction (gamma 2.2)')
+    for size in sizes:
+        pixels = makeFadeState(size).pixels
+        times = []
+        for dither in (False, True):
+            correction = opcBridge.ColorCorrection(gamma=2.2, dither=dither)
+            times.append(min(timeit.repeat(lambda: correction.apply(pixels), repeat=repeat, number=number)) / number)
+        print('  %6d pixels: %8.1f us/frame, %8.1f us/frame dithered' % (size, times[0] * 1e6, times[1] * 1e6))
+
+def benchEffects(counts=(0, 1, 4, 16, 64), pixelCount=4096, frames=200):
+    '''Frames per second of the effect engine against the number of effects
+    running at once, each effect driving an equal share of the pixels'''
+    print('Effects (%d pixels)' % pixelCount)
+    names = sorted(opcBridge.effects.EFFECTS)
+    for count in counts:
+        renderer = opcBridge.Renderer(60, pixelCount=pixelCount)
+        for effectID, indexes in enumerate(np.array_split(np.arange(pixelCount), count or 1)[:count]):
+            effect = opcBridge.Effect(names[effectID % len(names)], indexes, renderer.frameRate)
+            renderer.addEffect(str(effectID), effect)
+        def frame():
+            renderer.interpolate()
+            renderer.renderEffects()
+        best = min(timeit.repeat(frame, repeat=3, number=frames)) / frames
+        print('  %3d effects: %8.1f us/frame, %8.0f fps' % (count, best * 1e6, 1 / best))
+
+def startFlask(renderer):
+    '''Serve the Flask API on a free port from a background thread, as flaskServer.run does'''
+    #Request lines would flood the report
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = werkzeug.serving.make_server('127.0.0.1', 0, opcBridge.createFlaskServer(renderer, None), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_port, server.shutdown
+
+def startAsync(renderer):
+    '''Serve the asyncio API on a free port from an event loop on a background thread'''
+    loop = asyncio.new_event_loop()
+    listener = loop.run_until_complete(opcBridge.AsyncServer(renderer, None).start('127.0.0.1', 0))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return listener.sockets[0].getsockname()[1], lambda: loop.call_soon_threadsafe(listener.close)
+
+def loadClient(port, requests, barrier, latencies, errors):
+    '''Send absolute fades back to back over one connection, recording each latency'''
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    headers = {'Content-Type': 'application/json'}
+    barrier.wait()
+    for i in range(requests):
+        body = json.dumps({'rgb': '[%d, 0, 0]' % (i % 256), 'indexes': json.dumps(list(range(i % 64, i % 64 + 32))),
+                           'fadetime': 0.5})
+        start = time.perf_counter()
+        try:
+            connection.request('GET', '/absolutefade', body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(e)
+            connection.close()
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+def benchServers(clients=(1, 16, 64), requests=200):
+    '''Requests per second and latency of the Flask and asyncio servers, with
+    every client firing absolute fades at once to simulate a burst'''
+    print('REST API load (%d requests per client)' % requests)
+    for name, start in (('flask', startFlask), ('async', startAsync)):
+        for count in clients:
+            renderer = opcBridge.Renderer(60)
+            renderer.renderLoop.start()
+            port, stop = start(renderer)
+            latencies = []
+            errors = []
+            barrier = threading.Barrier(count + 1)
+            threads = [threading.Thread(target=loadClient, args=(port, requests, barrier, latencies, errors))
+                       for i in range(count)]
+            for thread in threads:
+                thread.start()
+            barrier.wait()
+            begin = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - begin
+            stop()
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+            print('  %s %3d clients: %8.0f req/s, p50 %6.2f ms, p99 %7.2f ms, %d errors'
+                  % (name, count, len(latencies) / elapsed, p50, p99, len(errors)))
+
+class SinkClient(opc.Client):
+    '''In-process stand-in for an OPC server: frames are encoded exactly as
+    opc.Client encodes them, then counted instead of written to a socket'''
+    def __init__(self, channel_map=None):
+        opc.Client.__init__(self, 'localhost:0', channel_map=channel_map)
+        self.frames = 0
+        self.bytes = 0
+
+    def put_pixels(self, pixels, channel=0):
+        start = time.perf_counter()
+        message = self._encode(pixels, channel)
+        self.encode_time = time.perf_counter() - start
+        self.frames += 1
+        self.bytes += len(message)
+        return True
+
+#A trace is a recorded session: universe size, framerate, stored scenes and,
+#for every frame, the commands that arrived during it as [command, args] pairs.
+#command is a Renderer method name, or 'scene' to recall a stored scene by name
+def traceFullStrip(pixelCount=512, frames=960, seed=0):
+    '''Multicommands repainting the whole strip in segments, four times a second'''
+    rng = np.random.default_rng(seed)
+    frameCommands = []
+    for frame in range(frames):
+        commands = []
+        if frame % 4 == 0:
+            segments = np.array_split(np.arange(pixelCount), 8)
+            commandList = [[segment.tolist(), rng.integers(0, 256, 3).tolist(), float(rng.uniform(0.25, 2)),
+                            opcBridge.CURVES[int(rng.integers(len(opcBridge.CURVES)))]] for segment in segments]
+            commands.append(['multiCommand', [commandList]])
+        frameCommands.append(commands)
+    return {'name': 'fullstrip', 'pixels': pixelCount, 'framerate': 16, 'scenes': {}, 'frames': frameCommands}
+
+def traceRelativeFades(pixelCount=512, frames=960, seed=1):
+    '''Short relative fades on random groups of pixels every frame, as a dimmer
+    knob being turned quickly, on a strip that starts lit'''
+    rng = np.random.default_rng(seed)
+    frameCommands = [[['absoluteFade', [[128, 96, 64], list(range(pixelCount)), 0]]]]
+    for frame in range(1, frames):
+        commands = []
+        for i in range(int(rng.integers(1, 6))):
+            indexes = np.sort(rng.choice(pixelCount, int(rng.integers(8, min(128, pixelCount))), replace=False))
+            commands.append(['relativeFade', [int(rng.integers(-40, 41)), indexes.tolist(), float(rng.uniform(0, 0.25))]])
+        frameCommands.append(commands)
+    return {'name': 'relativefades', 'pixels': pixelCount, 'framerate': 16, 'scenes': {}, 'frames': frameCommands}
+
+def traceMixedScenes(pixelCount=512, frames=960, seed=2):
+    '''Stored scenes recalled every two seconds, with absolute and relative
+    fades to parts of the strip in between'''
+    rng = np.random.default_rng(seed)
+    scenes = {}
+    for name in ('evening', 'reading', 'party', 'off'):
+        commandList = []
+        for segment in np.array_split(rng.permutation(pixelCount), 16):
+            color = [0, 0, 0] if name == 'off' else rng.integers(0, 256, 3).tolist()
+            commandList.append([np.sort(segment).tolist(), color, float(rng.uniform(0.5, 3)), 'perceptual'])
+        scenes[name] = commandList
+    frameCommands = []
+    for frame in range(frames):
+        commands = []
+        if frame % 32 == 0:
+            commands.append(['scene', sorted(scenes)[frame // 32 % len(scenes)]])
+        if frame % 8 == 4:
+            first = int(rng.integers(0, pixelCount - pixelCount // 8))
+            commands.append(['absoluteFade', [rng.integers(0, 256, 3).tolist(), list(range(first, first + pixelCount // 8)),
+                                              float(rng.uniform(0, 1)), 'easeinout']])
+        if frame % 8 == 6:
+            indexes = np.sort(rng.choice(pixelCount, pixelCount // 16, replace=False))
+            commands.append(['relativeFade', [int(rng.integers(-30, 31)), indexes.tolist(), 0.5]])
+        frameCommands.append(commands)
+    return {'name': 'mixedscenes', 'pixels': pixelCount, 'framerate': 16, 'scenes': scenes, 'frames': frameCommands}
+
+TRACES = (traceFullStrip, traceRelativeFades, traceMixedScenes)
+
+def replay(trace):
+    '''Drive a renderer through a trace as fast as it will go, with no
+    sleeping between frames, sending every frame to a SinkClient. Fades run on
+    the trace's time, frame n is rendered at n / framerate seconds. Returns the
+    time each frame took, from running its commands to its send finishing'''
+    renderer = opcBridge.Renderer(trace['framerate'], pixelCount=trace['pixels'])
+    sink = renderer.outputs[0].client = SinkClient()
+    scenes = {name: opcBridge.Scene(commandList, renderer.pixelCount)
+              for name, commandList in trace['scenes'].items()}
+    latencies = []
+    try:
+        for frame, commands in enumerate(trace['frames']):
+            for command, args in commands:
+                if command == 'scene':
+                    queued = renderer.submit(renderer.applyScene, [scenes[args]])
+                else:
+                    queued = renderer.submit(getattr(renderer, command), args)
+                if not queued:
+                    raise ValueError('trace %s queues more commands in a frame than the renderer holds' % trace['name'])
+            start = time.perf_counter()
+            renderer.renderFrame(now=frame / trace['framerate'])
+            renderer.flushOutputs()
+            latencies.append(time.perf_counter() - start)
+    finally:
+        renderer.sendPool.shutdown()
+    return latencies, sink
+
+def benchReplay(traces):
+    '''Frames per second, frame latency percentiles, OPC traffic and peak
+    memory of replaying each trace. Memory is measured on a second run, so
+    tracing allocations does not slow down the timed one'''
+    print('Replay (headless, in-process OPC sink)')
+    results = {}
+    for trace in traces:
+        latencies, sink = replay(trace)
+        tracemalloc.start()
+        replay(trace)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+        results[trace['name']] = {'pixels': trace['pixels'],
+                                  'frames': len(latencies),
+                                  'fps': round(len(latencies) / sum(latencies), 1),
+                                  'p50ms': round(float(p50), 4),
+                                  'p90ms': round(float(p90), 4),
+                                  'p99ms': round(float(p99), 4),
+                                  'maxms': round(max(latencies) * 1000, 4),
+                                  'opcframes': sink.frames,
+                                  'opcbytes': sink.bytes,
+                                  'peakmb': round(peak / 2 ** 20, 3)}
+        print('  %-14s %8.0f fps, p50 %7.3f ms, p99 %7.3f ms, %5d frames %9d bytes sent, peak %6.2f MB'
+              % (trace['name'], results[trace['name']]['fps'], p50, p99, sink.frames, sink.bytes, peak / 2 ** 20))
+    return results
+
+def saveResults(results, path):
+    '''Write replay results to a JSON file, with enough about the run to tell runs apart'''
+    with open(path, 'w') as f:
+        json.dump({'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                   'python': sys.version.split()[0],
+                   'numpy': np.__version__,
+                   'results': results}, f, indent=2)
+
+def compareResults(results, path):
+    '''Print how replay results moved against the results saved in path'''
+    with open(path) as f:
+        saved = json.load(f)
+    print('Replay compared to %s (%s)' % (path, saved['time']))
+    for name, result in results.items():
+        before = saved['results'].get(name)
+        if before is None:
+            print('  %-14s not in saved results' % name)
+            continue
+        changes = ['%s %+.1f%%' % (key, (result[key] - before[key]) * 100 / before[key])
+                   for key in ('fps', 'p50ms', 'p99ms', 'peakmb') if before[key]]
+        print('  %-14s %s' % (name, ', '.join(changes)))
+
+BENCHMARKS = ('step', 'encode', 'correct', 'effects', 'servers', 'replay')
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser(description=__doc__)
+    arguments.add_argument('benchmarks', nargs='*', choices=BENCHMARKS, help='Benchmarks to run, defaults to all of them')
+    arguments.add_argument('--trace', action='append', help='Replay this trace file instead of the built in traces')
+    arguments.add_argument('--save', help='Write replay results to this JSON file')
+    arguments.add_argument('--compare', help='Compare replay results with this saved JSON file')
+    arguments.add_argument('--record', help='Write the built in traces to this directory, to replay later')
+    options = arguments.parse_args()
+    chosen = options.benchmarks or BENCHMARKS
+    if options.record:
+        for makeTrace in TRACES:
+            trace = makeTrace()
+            with open(os.path.join(options.record, trace['name'] + '.json'), 'w') as f:
+                json.dump(trace, f)
+    if 'step' in chosen:
+        benchFrameStep()
+    if 'encode' in chosen:
+        benchEncode()
+    if 'correct' in chosen:
+        benchCorrection()
+    if 'effects' in chosen:
+        benchEffects()
+    if 'servers' in chosen:
+        benchServers()
+    if 'replay' in chosen:
+        if options.trace:
+            traces = []
+            for path in options.trace:
+                with open(path) as f:
+                    traces.append(json.load(f))
+        else:
+            traces = [makeTrace() for makeTrace in TRACES]
+        results = benchReplay(traces)
+        if options.compare:
+            compareResults(results, options.compare)
+        if options.save:
+            saveResults(results, options.save)
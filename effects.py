@@ -0,0 +1,85 @@
+'''Effects for the opcBridge effect engine
+Each effect is a generator function that takes the number of pixels it drives,
+the renderer's framerate and its own keyword parameters, then yields one
+count x 3 float32 array of pixel values per frame. Everything is computed with
+whole-array numpy operations, so the cost of an effect barely depends on how
+many pixels it covers'''
+import numpy as np
+
+def chase(count, frameRate, rgb=(255, 255, 255), background=(0, 0, 0), width=3, speed=10):
+    '''A block of width pixels running along the strip at speed pixels per second'''
+    rgb = np.asarray(rgb, dtype='float32')
+    background = np.asarray(background, dtype='float32')
+    positions = np.arange(count)
+    frame = 0
+    while True:
+        head = (frame * speed / frameRate) % max(count, 1)
+        #Distance behind the head of the chase, wrapping round the end of the strip
+        behind = (head - positions) % max(count, 1)
+        yield np.where((behind < width)[:, None], rgb, background)
+        frame += 1
+
+def twinkle(count, frameRate, rgb=(255, 255, 255), density=0.05, fadeTime=1, seed=None):
+    '''Pixels light up at random and fade out over fadeTime seconds.
+    density is the fraction of pixels that start a twinkle each second'''
+    rng = np.random.default_rng(seed)
+    rgb = np.asarray(rgb, dtype='float32')
+    decay = 1 / max(fadeTime * frameRate, 1)
+    level = np.zeros(count, dtype='float32')
+    while True:
+        level -= decay
+        np.maximum(level, 0, out=level)
+        level[rng.random(count) < density / frameRate] = 1
+        yield level[:, None] * rgb
+
+def rainbow(count, frameRate, speed=0.2, spread=1, brightness=255):
+    '''Hue wheel spread spread times along the strip, cycling speed times per second'''
+    positions = np.arange(count, dtype='float32') / max(count, 1) * spread
+    #Offset of the red, green and blue peaks around the hue wheel
+    phases = np.array([0, 1 / 3, 2 / 3], dtype='float32')
+    frame = 0
+    while True:
+        hue = (positions + frame * speed / frameRate)[:, None]
+        #Distance of each channel's peak from the hue, going the short way round the wheel
+        distance = np.abs((hue - phases + 0.5) % 1 - 0.5)
+        #Full within a sixth of the wheel, off a third of the wheel away
+        yield np.clip(2 - 6 * distance, 0, 1) * brightness
+        frame += 1
+
+def noise(count, frameRate, rgb=(255, 255, 255), speed=1, scale=8, seed=None):
+    '''Smoothly drifting brightness. Random values on a coarse grid of points
+    scale pixels apart are blended together along the strip, and the grid
+    drifts towards a new set of random values speed times per second'''
+    rng = np.random.default_rng(seed)
+    rgb = np.asarray(rgb, dtype='float32')
+    points = count // max(int(scale), 1) + 2
+    #Two rows of random control points, blended between over one second of frames
+    current = rng.random(points, dtype='float32')
+    upcoming = rng.random(points, dtype='float32')
+    positions = np.arange(count, dtype='float32') / max(scale, 1)
+    lower = positions.astype(np.intp)
+    fraction = positions - lower
+    smooth = fraction * fraction * (3 - 2 * fraction)
+    steps = max(int(frameRate / max(speed, 1e-3)), 1)
+    frame = 0
+    while True:
+        blend = (frame % steps) / steps
+        grid = current + (upcoming - current) * blend
+        level = grid[lower] + (grid[lower + 1] - grid[lower]) * smooth
+        yield level[:, None] * rgb
+        frame += 1
+        if not frame % steps:
+            current, upcoming = upcoming, rng.random(points, dtype='float32')
+
+#Effects that can be started by name
+EFFECTS = {'chase': chase,
+           'twinkle': twinkle,
+           'rainbow': rainbow,
+           'noise': noise}
+
+def create(name, count, frameRate, params=None):
+    '''Start the named effect for count pixels. Raises ValueError for unknown
+    effects, TypeError for parameters the effect does not take'''
+    if name not in EFFECTS:
+        raise ValueError('Unknown effect %s, expected one of %s' % (name, ', '.join(sorted(EFFECTS))))
+    return EFFECTS[name](count, frameRate, **(params or {}))
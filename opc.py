@@ -36,10 +36,20 @@ Recommended use:
 import socket
 import struct
 import sys
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# OPC message length is a 16 bit byte count
+MAX_PIXELS_PER_MESSAGE = 0xffff // 3
 
 class Client(object):
 
-    def __init__(self, server_ip_port, long_connection=True, verbose=False):
+    def __init__(self, server_ip_port, long_connection=True, verbose=False, channel_map=None,
+                 connect_timeout=0.5, send_timeout=0.5, max_backoff=5.0):
         """Create an OPC client object which sends pixels to an OPC server.
 
         server_ip_port should be an ip:port or hostname:port as a single string.
@@ -60,11 +70,52 @@ class Client(object):
 
         If verbose is True, the client will print debugging info to the console.
 
+        channel_map optionally spreads one large frame over several OPC channels.
+        It maps each OPC channel number to a (first index, pixel count) pair
+        within the frame handed to put_pixels.  For example, a Fadecandy board
+        with two 64 pixel strips: {1: (0, 64), 2: (64, 64)}
+
+        Connecting and sending never block for long, so a server that is down
+        or restarting does not stall the caller:
+        * connect_timeout is how many seconds a connection attempt may take.
+        * send_timeout is how many seconds sending one frame may take.  A
+          frame that misses it is dropped and the connection is reset, since
+          part of it may already be on the wire.
+        * After a failed connection attempt, put_pixels returns False
+          straight away until a backoff delay has passed.  The delay doubles
+          with each failure, up to max_backoff seconds.
+
+        The reconnects and dropped_frames attributes count connections
+        re-established after being lost and frames that could not be sent.
+        encode_time and send_time hold the seconds the last put_pixels spent
+        encoding the frame and writing it to the socket.
+
         """
         self.verbose = verbose
 
+        self._connect_timeout = connect_timeout
+        self._send_timeout = send_timeout
+        self._max_backoff = max_backoff
+        self._backoff = 0
+        self._next_attempt = 0
+        self._lost = False  # True once a live connection has failed
+        self.reconnects = 0
+        self.dropped_frames = 0
+        self.encode_time = 0
+        self.send_time = 0
+
+        self._channel_map = None
+        if channel_map:
+            self._channel_map = sorted((int(channel), int(first), int(count))
+                                       for channel, (first, count) in channel_map.items())
+
         self._long_connection = long_connection
 
+        # Reusable message buffer for numpy frames, rebuilt when the layout changes
+        self._frame_key = None
+        self._frame_buffer = None
+        self._frame_views = None
+
         self._ip, self._port = server_ip_port.split(':')
         self._port = int(self._port)
 
@@ -74,27 +125,44 @@ class Client(object):
         if self.verbose:
             print('    %s' % str(m))
 
-    def _ensure_connected(self):
+    def _ensure_connected(self, ignore_backoff=False):
         """Set up a connection if one doesn't already exist.
 
-        Return True on success or False on failure.
+        Return True on success or False on failure.  While backing off after
+        a failed attempt, return False without trying unless ignore_backoff.
 
         """
         if self._socket:
             self._debug('_ensure_connected: already connected, doing nothing')
             return True
 
+        if not ignore_backoff and time.monotonic() < self._next_attempt:
+            self._debug('_ensure_connected: backing off, not connecting')
+            return False
+
         try:
             self._debug('_ensure_connected: trying to connect...')
             self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._socket.settimeout(self._connect_timeout)
             self._socket.connect((self._ip, self._port))
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._socket.settimeout(self._send_timeout)
             self._debug('_ensure_connected:    ...success')
-            return True
         except socket.error:
             self._debug('_ensure_connected:    ...failure')
+            if self._socket:
+                self._socket.close()
             self._socket = None
+            self._backoff = min(max(self._backoff * 2, 0.1), self._max_backoff)
+            self._next_attempt = time.monotonic() + self._backoff
             return False
 
+        self._backoff = 0
+        if self._lost:
+            self.reconnects += 1
+            self._lost = False
+        return True
+
     def disconnect(self):
         """Drop the connection to the server, if there is one."""
         self._debug('disconnecting')
@@ -111,11 +179,134 @@ class Client(object):
         subsequent put_pixels calls.
 
         """
-        success = self._ensure_connected()
+        success = self._ensure_connected(ignore_backoff=True)
         if not self._long_connection:
             self.disconnect()
         return success
 
+    def _single_message(self, pixel_count):
+        """Return True if a frame can be sent as one message on channel 0.
+
+        This is the case when there is no channel map, or when the mapped
+        channels cover the frame contiguously in channel order and the whole
+        frame fits in a single OPC message.
+
+        """
+        if not self._channel_map:
+            return True
+        if pixel_count > MAX_PIXELS_PER_MESSAGE:
+            return False
+        next_index = 0
+        for channel, first, count in self._channel_map:
+            if first != next_index:
+                return False
+            next_index = first + count
+        return next_index == pixel_count
+
+    def channel_offset(self, channel):
+        """Return the frame index that an OPC channel starts at.
+
+        Channel 0 starts at the first pixel.  Other channels are looked up in
+        the channel_map, None is returned for channels that are not mapped.
+
+        """
+        if not channel:
+            return 0
+        for mapped, first, count in self._channel_map or ():
+            if mapped == channel:
+                return first
+        return None
+
+    def _build_message(self, channel, pixels):
+        """Pack a list of pixels into a single OPC set pixel colors message."""
+        if len(pixels) > MAX_PIXELS_PER_MESSAGE:
+            raise ValueError('%d pixels do not fit in a single OPC message, '
+                             'use a channel_map to split them' % len(pixels))
+
+        len_hi_byte = int(len(pixels)*3 / 256)
+        len_lo_byte = (len(pixels)*3) % 256
+        command = 0  # set pixel colors from openpixelcontrol.org
+
+        header = struct.pack("BBBB", channel, command, len_hi_byte, len_lo_byte)
+
+        pieces = [ struct.pack( "BBB", int(r), int(g), int(b)) for r, g, b in pixels ]
+
+        if sys.version_info[0] == 3:
+            # bytes!
+            return header + b''.join(pieces)
+        else:
+            # strings!
+            return header + ''.join(pieces)
+
+    def _frame_layout(self, pixel_count, channel):
+        """Return the preallocated message buffer for a frame, and a list of
+        (payload view, first index, count) that the frame is copied into.
+
+        The header bytes are written once when the layout is built, so encoding
+        a frame only has to fill in the payload views.
+
+        """
+        key = (pixel_count, channel)
+        if key == self._frame_key:
+            return self._frame_buffer, self._frame_views
+
+        if channel or self._single_message(pixel_count):
+            messages = [(channel, 0, pixel_count)]
+        else:
+            messages = self._channel_map
+        for mapped, first, count in messages:
+            if count > MAX_PIXELS_PER_MESSAGE:
+                raise ValueError('%d pixels do not fit in a single OPC message, '
+                                 'use a channel_map to split them' % count)
+
+        buffer = bytearray(sum(4 + count * 3 for mapped, first, count in messages))
+        views = []
+        offset = 0
+        for mapped, first, count in messages:
+            struct.pack_into(">BBH", buffer, offset, mapped, 0, count * 3)
+            payload = numpy.frombuffer(buffer, dtype=numpy.uint8, count=count * 3,
+                                       offset=offset + 4).reshape(count, 3)
+            views.append((payload, first, count))
+            offset += 4 + count * 3
+
+        self._frame_key = key
+        self._frame_buffer = buffer
+        self._frame_views = views
+        return buffer, views
+
+    def check_frame(self, pixel_count, channel=0):
+        """Raise ValueError if a frame of pixel_count pixels cannot be sent.
+
+        A frame is only encoded when it is sent, so call this up front to find
+        out about a frame that is too big for one OPC message and has no
+        channel_map to split it, rather than having every put_pixels fail.
+
+        """
+        self._frame_layout(pixel_count, channel)
+
+    def _encode_array(self, pixels, channel):
+        """Encode a numpy frame into the reusable message buffer.
+
+        Values are clamped to 0-255 and rounded down, matching the list path.
+        Returns a memoryview of the buffer, which is overwritten by the next
+        call.
+
+        """
+        buffer, views = self._frame_layout(len(pixels), channel)
+        for payload, first, count in views:
+            numpy.clip(pixels[first:first + count], 0, 255, out=payload, casting='unsafe')
+        return memoryview(buffer)
+
+    def _encode(self, pixels, channel=0):
+        """Return the complete OPC message(s) for a frame."""
+        if numpy is not None and isinstance(pixels, numpy.ndarray):
+            return self._encode_array(pixels, channel)
+        if channel or self._single_message(len(pixels)):
+            return self._build_message(channel, pixels)
+        messages = [self._build_message(mapped, pixels[first:first + count])
+                    for mapped, first, count in self._channel_map]
+        return messages[0][:0].join(messages)
+
     def put_pixels(self, pixels, channel=0):
         """Send the list of pixel colors to the OPC server on the given channel.
 
@@ -128,6 +319,8 @@ class Client(object):
             For example: [(255, 255, 255), (0, 0, 0), (127, 0, 0)]
             Floats will be rounded down to integers.
             Values outside the legal range will be clamped.
+            An N x 3 numpy array is also accepted, and is encoded straight
+            into a reusable buffer without building any per pixel objects.
 
         Will establish a connection to the server as needed.
 
@@ -138,35 +331,35 @@ class Client(object):
         with the first LED.  It's not possible to send a color just to one
         LED at a time (unless it's the first one).
 
+        If the client has a channel_map and channel is 0, the frame is sent as
+        one message per mapped channel, unless it can go out as a single
+        channel 0 message.
+
         """
         self._debug('put_pixels: connecting')
         is_connected = self._ensure_connected()
         if not is_connected:
             self._debug('put_pixels: not connected.  ignoring these pixels.')
+            self.dropped_frames += 1
             return False
 
-        # build OPC message
-        len_hi_byte = int(len(pixels)*3 / 256)
-        len_lo_byte = (len(pixels)*3) % 256
-        command = 0  # set pixel colors from openpixelcontrol.org
-
-        header = struct.pack("BBBB", channel, command, len_hi_byte, len_lo_byte)
-
-        pieces = [ struct.pack( "BBB", int(r), int(g), int(b)) for r, g, b in pixels ]
-
-        if sys.version_info[0] == 3:
-            # bytes!
-            message = header + b''.join(pieces)
-        else:
-            # strings!
-            message = header + ''.join(pieces)
+        # build OPC message(s)
+        start = time.perf_counter()
+        message = self._encode(pixels, channel)
+        encoded = time.perf_counter()
+        self.encode_time = encoded - start
 
         self._debug('put_pixels: sending pixels to server')
         try:
-            self._socket.send(message)
+            self._socket.sendall(message)
+            self.send_time = time.perf_counter() - encoded
         except socket.error:
+            # Includes timeouts: part of the frame may have been sent, so the
+            # connection can't be trusted to be on a message boundary any more
             self._debug('put_pixels: connection lost.  could not send pixels.')
-            self._socket = None
+            self.disconnect()
+            self._lost = True
+            self.dropped_frames += 1
             return False
 
         if not self._long_connection:
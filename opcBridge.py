@@ -1,18 +1,60 @@
 import opc
+import effects
 import time
 import os
 import socket
+import socketserver
+import struct
 import json
 import threading
 import queue
+import itertools
+import collections
+import concurrent.futures
+import asyncio
+import urllib.parse
+import http
+import base64
 import datetime
 import numpy as np
 import yaml
-from flask import Flask, request
+from flask import Flask, Response, request
 from flask_restful import Resource, Api, reqparse
 import logging
+import logging.handlers
+import sys
 import requests
 
+#################################LOGGING########################################
+#Log records are queued and written out from a background thread, so reporting
+#an error never waits on the disk
+LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opcBridge-log.txt')
+logger = logging.getLogger('opcBridge')
+logger.setLevel(logging.INFO)
+
+def startLogging(path=LOG_PATH):
+    '''Start writing log records to path and the console. Returns the
+    QueueListener doing the writing, pass it to stopLogging to flush it'''
+    records = queue.Queue()
+    logFile = logging.FileHandler(path)
+    logFile.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    listener = logging.handlers.QueueListener(records, logFile, logging.StreamHandler(sys.stdout))
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    listener.start()
+    return listener
+
+def stopLogging(listener):
+    '''Write out any queued records and close the log file'''
+    for handler in list(logger.handlers):
+        if getattr(handler, 'queue', None) is listener.queue:
+            logger.removeHandler(handler)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+def logError(err):
+    logger.error(err)
+
 ############################SUPPORT FUNCTIONS###################################
 def getLocalIP():
     '''Get our IP address'''
@@ -31,10 +73,23 @@ def getLocalIP():
 def pixelsToJson(npArray):
     '''numPy arrays do not cleanly serialize. This takes our numPy array and converts
     to a standard python list so that we can easily dump it as JSON'''
-    lstOut = []
-    for i in npArray:
-        lstOut.append([int(i[0]), int(i[1]), int(i[2])])
-    return lstOut
+    return np.asarray(npArray).astype(int).tolist()
+
+#Encodings the pixels endpoint can return
+PIXEL_FORMATS = ('json', 'raw', 'base64', 'hex')
+
+def encodePixels(frame, fmt='json'):
+    '''Encode an 8 bit N x 3 frame for the pixels endpoint.
+    raw returns bytes, every other format returns a JSON serializable object'''
+    if fmt == 'json':
+        return frame.tolist()
+    if fmt == 'raw':
+        return frame.tobytes()
+    if fmt == 'base64':
+        return base64.b64encode(frame.tobytes()).decode('ascii')
+    if fmt == 'hex':
+        return frame.tobytes().hex()
+    raise ValueError('Unknown pixel format %s, expected one of %s' % (fmt, ', '.join(PIXEL_FORMATS)))
 
 def makeEightBit(value):
     return min(255, max(0, int(value)))
@@ -63,183 +118,1165 @@ def brightnessChange(rgb, magnitude):
     else:
         return rgb
 
+#Fade curves, a fade stores the position of its curve in this tuple
+CURVES = ('linear', 'easeinout', 'exponential', 'perceptual')
+#Curve lookup tables: fraction of the fade completed at CURVE_STEPS + 1 evenly spaced points in time
+CURVE_STEPS = 1024
+_curveTime = np.linspace(0, 1, CURVE_STEPS + 1)
+CURVE_TABLES = np.array([
+    _curveTime,
+    0.5 - 0.5 * np.cos(np.pi * _curveTime),
+    (np.exp2(10 * _curveTime) - 1) / (2 ** 10 - 1),
+    #Perceptual fades move linearly through gamma encoded brightness
+    _curveTime], dtype='float32')
+PERCEPTUAL = CURVES.index('perceptual')
+#Gamma encoding and decoding tables for perceptual fades, GAMMA_STEPS + 1 entries
+#covering 0-255 and 0-1 respectively
+PERCEPTUAL_GAMMA = 2.2
+GAMMA_STEPS = 4096
+_gammaSteps = np.linspace(0, 1, GAMMA_STEPS + 1)
+GAMMA_ENCODE = (_gammaSteps ** (1 / PERCEPTUAL_GAMMA)).astype('float32')
+GAMMA_DECODE = (255 * _gammaSteps ** PERCEPTUAL_GAMMA).astype('float32')
+
+def tableLookup(table, position, offset=0):
+    '''Read a lookup table at fractional positions, interpolating linearly
+    between neighbouring entries. For a 2D table, offset is the flattened
+    start of the row each position is read from'''
+    steps = table.shape[-1] - 1
+    position = np.clip(position, 0, steps)
+    lower = np.minimum(position.astype(np.intp), steps - 1)
+    fraction = (position - lower).astype('float32')
+    flat = table.ravel()
+    lower += offset
+    low = flat[lower]
+    return low + (flat[lower + 1] - low) * fraction
+
+def curveIndex(curve):
+    '''Position of a curve name in CURVES, None means linear'''
+    if curve is None:
+        return 0
+    if curve not in CURVES:
+        raise ValueError('Unknown curve %s, expected one of %s' % (curve, ', '.join(CURVES)))
+    return CURVES.index(curve)
+
+def ease(startVals, endVals, progress, curves):
+    '''Evaluate N fades at once. progress is the fraction of time elapsed for
+    each fade, curves the curve index of each fade. Returns the N x 3 values'''
+    if not curves.any():
+        #Every fade is linear, the curve is the progress itself
+        amount = progress.astype('float32')[:, None]
+        return startVals + (endVals - startVals) * amount
+    amount = tableLookup(CURVE_TABLES, progress * CURVE_STEPS,
+                         curves.astype(np.intp) * (CURVE_STEPS + 1))[:, None]
+    values = startVals + (endVals - startVals) * amount
+    perceptual = np.flatnonzero(curves == PERCEPTUAL)
+    if len(perceptual):
+        start = tableLookup(GAMMA_ENCODE, startVals[perceptual] * (GAMMA_STEPS / 255))
+        end = tableLookup(GAMMA_ENCODE, endVals[perceptual] * (GAMMA_STEPS / 255))
+        values[perceptual] = tableLookup(GAMMA_DECODE, (start + (end - start) * amount[perceptual]) * GAMMA_STEPS)
+    return values
+
+def fadeDuration(fadeTime):
+    '''Seconds a fade takes. Missing or negative fade times finish on the next frame'''
+    return max(0.0, float(fadeTime or 0))
+
+def flattenCommands(commandList):
+    '''Flatten a multicommand list into one index array with a color, fade
+    time and curve per index, ready for Renderer.fadeTo'''
+    counts = [len(x[0]) for x in commandList]
+    indexes = np.fromiter(itertools.chain.from_iterable(x[0] for x in commandList), dtype=np.intp, count=sum(counts))
+    rgb = np.repeat(np.array([x[1] for x in commandList], dtype='float32'), counts, axis=0)
+    times = np.repeat([fadeDuration(x[2]) for x in commandList], counts)
+    curves = np.repeat([curveIndex(x[3] if len(x) > 3 else None) for x in commandList], counts)
+    return indexes, rgb, times, curves.astype(np.uint8)
+
+def brightnessChangeArray(rgb, magnitude):
+    '''Vectorized brightnessChange: takes an N x 3 array of RGB values and a
+    brightness change, returns a new array of final values'''
+    rgb = np.asarray(rgb, dtype='float32')
+    currentBri = rgb.max(axis=1)
+    newBri = np.clip(np.trunc(currentBri + magnitude), 0, 255)
+    #Never dim a lit pixel all the way to zero
+    newBri[newBri == 0] = 1
+    change = (currentBri != 0) & (currentBri != newBri)
+    rgbOut = rgb.copy()
+    rgbOut[change] = rgb[change] * (newBri[change] / currentBri[change])[:, None]
+    return rgbOut
+
 ################################################################################
 
 class PSU:
-    def __init__(self, ip, index, port=8001):
+    def __init__(self, ip, index, port=8001, debounce=2, retryDelay=5, pixels=None):
         self.ip = ip
         self.port = port
         self.index = index
+        #Range of pixel indexes [start, stop) powered by this PSU, None for all of them
+        self.start, self.stop = pixels or (None, None)
+        #State we want the relay in
         self.state = False
+        #State the relay last confirmed, None until we have heard from it
+        self.relayState = None
+        #Seconds the PSU must stay unwanted before it is switched off
+        self.debounce = debounce
+        #Seconds to wait before retrying an unreachable relay
+        self.retryDelay = retryDelay
+        self.url = 'http://' + self.ip + ':' + str(self.port) + '/switch'
+        #Keep-alive connection pool to the relay processor
+        self.session = requests.Session()
+        #Guards state, wakes the relay worker when it changes
+        self.changed = threading.Condition()
+        self.changedAt = 0
+        self.relayWorker = None
 
     def switch(self, state):
-        '''Switch relay attached to lighting PSU'''
+        '''Switch relay attached to lighting PSU. Returns immediately, the
+        request is made from a background worker so callers never wait on
+        the relay'''
+        with self.changed:
+            if state != self.state:
+                self.changedAt = time.monotonic()
+            self.state = state
+            if self.relayWorker is None:
+                self.relayWorker = threading.Thread(target=self.relayLoop)
+                self.relayWorker.daemon = True
+                self.relayWorker.start()
+            self.changed.notify_all()
+
+    def sendSwitch(self, state):
+        '''Make the HTTP request to the relay processor, returns True on success'''
         try:
             params = {'index': self.index, 'state': state}
-            requests.get('http://' + self.ip + ':' + str(self.port) + '/switch', json=params, timeout=3)
-            self.state = state
+            self.session.get(self.url, json=params, timeout=3)
+            return True
         except Exception as e:
-            print('Failed to connect to relay processor')
-            print(e)
+            logger.warning('Failed to connect to relay processor: %s', e)
+            return False
+
+    def relayLoop(self):
+        '''Background worker: bring the relay in line with the wanted state.
+        Switching off is debounced, so the PSU is not cycled by lights that
+        go dark briefly, switching on happens straight away'''
+        while True:
+            with self.changed:
+                while self.state == self.relayState:
+                    self.changed.wait()
+                if not self.state:
+                    settle = self.changedAt + self.debounce - time.monotonic()
+                    if settle > 0:
+                        self.changed.wait(settle)
+                        continue
+                state = self.state
+            if self.sendSwitch(state):
+                with self.changed:
+                    self.relayState = state
+                    self.changed.notify_all()
+            else:
+                time.sleep(self.retryDelay)
+
+    def wait(self, timeout=None):
+        '''Block until the relay has confirmed the wanted state.
+        Returns False if that did not happen within timeout'''
+        with self.changed:
+            return self.changed.wait_for(lambda: self.state == self.relayState, timeout)
 
     def checkPixels(self, pixels):
-        '''Crawl down pixel array, if any value is above 0 return true
+        '''If any value in this PSU's range of the pixel array is above 0 return true
         Used in conjunction with self.switch to kill power to PSU if lights are off'''
-        for pix in pixels:
-            for color in pix:
-                if color > 0:
-                    return True
-        return False
-
-    def update(self, pixels):
-        '''If pixel array has no lights on, kill its associated PSU'''
-        if self.checkPixels(pixels):
+        return bool(np.any(np.asarray(pixels)[self.start:self.stop] > 0))
+
+    def update(self, lit):
+        '''Takes the renderer's lit bitmap, if no pixels in our range are lit,
+        kill the associated PSU'''
+        if np.any(lit[self.start:self.stop]):
             if not self.state:
-                print('Spinning up PSU')
+                logger.info('Spinning up PSU')
                 self.switch(True)
         else:
             if self.state:
-                print('Killing PSU')
+                logger.info('Killing PSU')
                 self.switch(False)
 
 
+class Effect:
+    '''A running effect: its name, parameters, the pixels it drives, and the
+    generator producing its frames'''
+    def __init__(self, name, indexes, frameRate, params=None):
+        self.name = name
+        self.params = params or {}
+        self.indexes = np.asarray(indexes, dtype=np.intp).ravel()
+        if not len(self.indexes):
+            raise ValueError('an effect needs at least one pixel')
+        self.frames = effects.create(name, len(self.indexes), frameRate, self.params)
+
+    def describe(self):
+        return {'effect': self.name, 'params': self.params, 'pixels': len(self.indexes)}
+
+
+class Scene:
+    '''A multicommand compiled into arrays that can be handed straight to
+    Renderer.fadeTo: each pixel the scene sets once, with its final color,
+    fade time and curve'''
+    def __init__(self, commandList, pixelCount):
+        indexes, rgb, times, curves = flattenCommands(commandList)
+        if len(indexes) and not 0 <= indexes.min() <= indexes.max() < pixelCount:
+            raise IndexError('indexes must be between 0 and %d' % (pixelCount - 1))
+        #Resolve pixels set more than once, the last command wins
+        targets = np.zeros((pixelCount, 3), dtype='float32')
+        targetTimes = np.zeros((pixelCount), dtype='float64')
+        targetCurves = np.zeros((pixelCount), dtype=np.uint8)
+        touched = np.zeros((pixelCount), dtype=bool)
+        targets[indexes] = rgb
+        targetTimes[indexes] = times
+        targetCurves[indexes] = curves
+        touched[indexes] = True
+        self.indexes = np.flatnonzero(touched)
+        self.targets = targets[self.indexes]
+        self.times = targetTimes[self.indexes]
+        self.curves = targetCurves[self.indexes]
+
+
+class SceneLibrary:
+    '''Named scenes, stored as multicommand lists in a YAML file. Scenes are
+    compiled on first use and the most recently used are kept compiled'''
+    def __init__(self, path, pixelCount, cacheSize=32):
+        self.path = path
+        self.pixelCount = pixelCount
+        self.cacheSize = cacheSize
+        self.lock = threading.Lock()
+        #Compiled scenes, least recently used first
+        self.compiled = collections.OrderedDict()
+        self.scenes = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.scenes = yaml.safe_load(f) or {}
+
+    def names(self):
+        return sorted(self.scenes)
+
+    def get(self, name):
+        '''Return the compiled scene, raises KeyError for unknown scenes'''
+        with self.lock:
+            if name in self.compiled:
+                self.compiled.move_to_end(name)
+                return self.compiled[name]
+            scene = Scene(self.scenes[name], self.pixelCount)
+            self.compiled[name] = scene
+            if len(self.compiled) > self.cacheSize:
+                self.compiled.popitem(last=False)
+            return scene
+
+    def save(self, name, commandList):
+        '''Store a scene and write the library to disk. The scene is compiled
+        first, so invalid names and command lists raise before anything is stored'''
+        if not isinstance(name, str) or not name:
+            raise TypeError('scene name must be a non-empty string')
+        scene = Scene(commandList, self.pixelCount)
+        with self.lock:
+            self.scenes[name] = commandList
+            self.compiled[name] = scene
+            self.compiled.move_to_end(name)
+            if len(self.compiled) > self.cacheSize:
+                self.compiled.popitem(last=False)
+            self.write()
+
+    def delete(self, name):
+        with self.lock:
+            del self.scenes[name]
+            self.compiled.pop(name, None)
+            self.write()
+
+    def write(self):
+        '''Write all scenes to disk, replacing the file in one step'''
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            yaml.safe_dump(self.scenes, f, default_flow_style=None)
+        os.replace(temporary, self.path)
+
+
+class FrameClock:
+    '''Frame scheduler. Frames are due on absolute deadlines spaced interval
+    apart, so time spent rendering or waiting never pushes later frames back.
+    The interval starts at 1/frameRate and, given a minFrameRate, stretches
+    while frames take longer than it to render and shrinks back once they are
+    quick again. Keeps rolling frame time statistics'''
+    def __init__(self, frameRate, window=256, maxMerge=None, minFrameRate=None):
+        self.period = 1 / frameRate
+        self.interval = self.period
+        self.maxInterval = max(self.period, 1 / (minFrameRate or frameRate))
+        #Part of a frame period carried over when the interval is not a whole number of periods
+        self.owed = 0
+        #Most intervals that may be merged into one when catching up, beyond that they are dropped
+        self.maxMerge = maxMerge or max(1, int(frameRate))
+        self.deadline = None
+        #Start times and work times of the most recent frames
+        self.frameStarts = collections.deque(maxlen=window)
+        self.frameTimes = collections.deque(maxlen=window)
+        self.frames = 0
+        self.late = 0
+        self.dropped = 0
+
+    def reset(self):
+        '''Start counting deadlines from now, used when the render loop wakes up'''
+        self.deadline = time.perf_counter() + self.interval
+        self.owed = 0
+        self.frameStarts.clear()
+
+    def record(self, frameStart, frameTime):
+        '''Log the start and amount of work of a completed frame, and adapt
+        the interval to it'''
+        self.frameStarts.append(frameStart)
+        self.frameTimes.append(frameTime)
+        self.frames += 1
+        if frameTime > self.interval:
+            self.interval = min(self.interval * 1.25, self.maxInterval)
+        elif frameTime < self.interval / 2:
+            self.interval = max(self.interval * 0.9, self.period)
+
+    def steps(self, intervals):
+        '''Whole frame periods covered by a number of intervals'''
+        periods = intervals * self.interval / self.period + self.owed
+        steps = int(periods)
+        self.owed = periods - steps
+        return steps
+
+    def wait(self):
+        '''Sleep until the next frame is due. Returns how many frame periods
+        the next frame should cover: 1 when on time at the full framerate,
+        more when the interval is stretched or the loop fell behind and
+        missed deadlines are merged into the next frame'''
+        if self.deadline is None:
+            self.reset()
+        now = time.perf_counter()
+        if now < self.deadline:
+            time.sleep(self.deadline - now)
+            self.deadline += self.interval
+            return self.steps(1)
+        self.late += 1
+        missed = int((now - self.deadline) / self.interval)
+        if missed >= self.maxMerge:
+            #Too far behind to catch up, drop the backlog and resync
+            self.dropped += missed
+            self.deadline = now + self.interval
+            return self.steps(1)
+        self.deadline += (missed + 1) * self.interval
+        return self.steps(missed + 1)
+
+    def stats(self):
+        '''Rolling frame statistics over the recent window'''
+        fps = 0
+        if len(self.frameStarts) > 1:
+            span = self.frameStarts[-1] - self.frameStarts[0]
+            if span > 0:
+                fps = (len(self.frameStarts) - 1) / span
+        frameTimes = np.array(self.frameTimes or [0]) * 1000
+        return {'targetfps': 1 / self.period,
+                'renderfps': round(1 / self.interval, 2),
+                'fps': round(fps, 2),
+                'p50ms': round(float(np.percentile(frameTimes, 50)), 3),
+                'p99ms': round(float(np.percentile(frameTimes, 99)), 3),
+                'frames': self.frames,
+                'late': self.late,
+                'dropped': self.dropped}
+
+
+class PhaseTimers:
+    '''Rolling timings of the phases of the render loop and of the OPC sends.
+    Recorded from the render thread and the send threads'''
+    def __init__(self, phases, window=256):
+        self.phases = phases
+        self.times = {phase: collections.deque(maxlen=window) for phase in phases}
+        #Totals since boot, for the metrics summaries
+        self.totals = dict.fromkeys(phases, 0.0)
+        self.counts = dict.fromkeys(phases, 0)
+        self.lock = threading.Lock()
+
+    def record(self, phase, seconds):
+        with self.lock:
+            self.times[phase].append(seconds)
+            self.totals[phase] += seconds
+            self.counts[phase] += 1
+
+    def lap(self, phase, start):
+        '''Record the time since start against phase. Returns the current
+        time, to start the next lap from'''
+        now = time.perf_counter()
+        self.record(phase, now - start)
+        return now
+
+    def stats(self):
+        '''Median and 99th percentile of each phase over the recent window, in milliseconds'''
+        with self.lock:
+            recent = {phase: list(self.times[phase]) or [0] for phase in self.phases}
+        stats = {}
+        for phase in self.phases:
+            p50, p99 = np.percentile(recent[phase], [50, 99]) * 1000
+            stats[phase] = {'p50ms': round(float(p50), 4), 'p99ms': round(float(p99), 4)}
+        return stats
+
+
+class SamplingProfiler:
+    '''Statistical profiler for one thread. While running, a background
+    thread looks at the profiled thread's call stack every interval seconds and
+    counts how often each stack is seen. The profiled thread runs untouched'''
+    def __init__(self, thread, interval=0.005):
+        self.thread = thread
+        self.interval = interval
+        #Call stack, outermost call first and joined with ; -> times seen
+        self.stacks = collections.Counter()
+        self.samples = 0
+        #Held while stacks and samples are updated or read, so a report never
+        #ranks the counter while the sampler adds to it
+        self.lock = threading.Lock()
+        self.running = threading.Event()
+        self.sampler = None
+
+    def start(self, interval=None):
+        '''Start sampling, clearing the previous profile'''
+        if self.running.is_set():
+            return
+        if interval:
+            self.interval = interval
+        with self.lock:
+            self.stacks = collections.Counter()
+            self.samples = 0
+        self.running.set()
+        self.sampler = threading.Thread(target=self.sample)
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+
+    def sample(self):
+        while self.running.is_set():
+            frame = sys._current_frames().get(self.thread.ident)
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    stack.append('%s:%s' % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                    frame = frame.f_back
+                stack = ';'.join(reversed(stack))
+                with self.lock:
+                    self.stacks[stack] += 1
+                    self.samples += 1
+            del frame
+            time.sleep(self.interval)
+
+    def report(self, top=20):
+        '''The most sampled stacks, in the collapsed stack format flame graph tools read'''
+        with self.lock:
+            stacks = self.stacks.most_common(top)
+            samples = self.samples
+        return {'running': self.running.is_set(),
+                'interval': self.interval,
+                'samples': samples,
+                'stacks': [{'stack': stack, 'samples': count} for stack, count in stacks]}
+
+
+class ColorCorrection:
+    '''Output stage turning rendered float frames into the 8 bit values sent
+    to OPC servers. Each channel goes through a lookup table applying gamma
+    and white balance, 255 * whitePoint * (value / 255) ** gamma. With dither
+    the part of each value between two 8 bit levels is carried over to the
+    next frame, so over several frames a pixel averages out to its exact
+    corrected value instead of being rounded. Dithering only pays off while
+    a pixel moves: once it has held still for settleFrames frames it is
+    rounded instead, so a static scene stops needing new frames'''
+    #Fraction of a level treated as no fraction at all, so values that are whole
+    #levels but for rounding error do not flicker
+    SETTLED = 1 / 256
+
+    def __init__(self, gamma=1.0, whitePoint=None, dither=False, settleFrames=32, steps=4096):
+        self.gamma = gamma
+        self.whitePoint = np.asarray(whitePoint or (1, 1, 1), dtype='float32')
+        self.dither = dither
+        self.settleFrames = settleFrames
+        self.steps = steps
+        levels = np.linspace(0, 1, steps + 1)
+        #One row per channel, steps + 1 entries covering 0-255
+        self.table = (255 * self.whitePoint[:, None] * levels ** gamma).astype('float32')
+        #Flattened start of each channel's row in the table
+        self.offsets = np.arange(3) * (steps + 1)
+        #Output buffer, the fraction of a level each value is owed, the last
+        #frame corrected and how many frames each pixel has held still for,
+        #sized on first use
+        self.output = None
+        self.error = None
+        self.previous = None
+        self.still = None
+        #True while dithering holds any value between two levels
+        self.active = False
+
+    def apply(self, pixels):
+        '''Correct an N x 3 frame. Returns the 8 bit output buffer, which is
+        overwritten by the next call'''
+        if self.output is None or self.output.shape != pixels.shape:
+            self.output = np.zeros(pixels.shape, dtype=np.uint8)
+            self.error = np.zeros(pixels.shape, dtype='float32')
+            self.previous = np.zeros(pixels.shape, dtype='float32')
+            self.still = np.zeros(len(pixels), dtype=np.uint16)
+        values = tableLookup(self.table, pixels * (self.steps / 255), self.offsets)
+        if self.dither:
+            moved = np.any(pixels != self.previous, axis=1)
+            self.previous[:] = pixels
+            self.still += 1
+            self.still[moved] = 0
+            np.minimum(self.still, self.settleFrames, out=self.still)
+            #Values on a whole level, and pixels that have settled, are shown
+            #rounded and drop what they were owed
+            steady = (values - np.floor(values + self.SETTLED) < self.SETTLED) | (self.still >= self.settleFrames)[:, None]
+            dithered = values + self.error
+            levels = np.where(steady, np.rint(values), np.floor(dithered + self.SETTLED))
+            np.subtract(dithered, levels, out=self.error)
+            #Values outside 0-255 cannot be shown, so nothing is owed for them
+            np.clip(self.error, 0, 1, out=self.error)
+            self.error[steady | (self.error < self.SETTLED)] = 0
+            self.active = bool(self.error.any())
+        else:
+            levels = np.rint(values)
+        np.clip(levels, 0, 255, out=self.output, casting='unsafe')
+        return self.output
+
+
+class Output:
+    '''One OPC server, receiving the [start, stop) slice of every frame.
+    Frames identical to the last one sent are skipped until keepAlive
+    seconds have passed (never, if keepAlive is None)'''
+    def __init__(self, server, pixels=None, channels=None, keepAlive=None):
+        self.server = server
+        self.client = opc.Client(server, channel_map=channels)
+        self.start, self.stop = pixels or (0, None)
+        self.keepAlive = keepAlive
+        #Send in flight on the renderer's send pool, and the newest frame held
+        #back while it runs, sent by the same worker once it finishes
+        self.pending = None
+        self.waiting = None
+        self.lock = threading.Lock()
+        #True while the last send failed, the frame is retried every frame until it succeeds
+        self.failed = False
+        self.lastSent = None
+        self.lastSentAt = None
+        self.framesSent = 0
+        self.framesSkipped = 0
+        self.bytesSent = 0
+        self.bytesSaved = 0
+        #Frames held back because the previous send had not finished, only
+        #the newest of them is sent
+        self.framesBusy = 0
+
+    def checkLayout(self, pixelCount):
+        '''Raise ValueError if this output's slice of a pixelCount pixel frame
+        cannot be sent to its server'''
+        self.client.check_frame(len(range(pixelCount)[self.start:self.stop]))
+
+    def due(self, frame, now):
+        '''Should this frame be sent, or is it a repeat of the last one.
+        After a failed send every frame is sent until one gets through'''
+        if (not self.failed and self.lastSentAt is not None and np.array_equal(frame, self.lastSent)
+                and (self.keepAlive is None or now - self.lastSentAt < self.keepAlive)):
+            self.framesSkipped += 1
+            self.bytesSaved += frame.nbytes
+            return False
+        return True
+
+    def send(self, frame, now):
+        '''Send a frame to the server, runs on a send pool thread'''
+        try:
+            sent = self.client.put_pixels(frame)
+        except Exception as e:
+            logger.warning('Unable to contact opc Client %s: %s', self.server, e)
+            sent = False
+        #Frames that fail to send are retried next time, even if unchanged
+        self.failed = not sent
+        if sent:
+            self.lastSent = frame
+            self.lastSentAt = now
+            self.framesSent += 1
+            self.bytesSent += frame.nbytes
+        return sent
+
+
+#Phases of a frame timed by the renderer. encode and send happen on the send
+#threads, once per output, dispatch is handing the frame to them
+RENDER_PHASES = ('commands', 'interpolate', 'effects', 'psu', 'publish', 'correct', 'dispatch', 'encode', 'send')
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+#Renderer.stats key -> Prometheus metric name, type and help
+METRICS = (('frames', 'opcbridge_frames_total', 'counter', 'Frames rendered'),
+           ('late', 'opcbridge_frames_late_total', 'counter', 'Frames started after their deadline'),
+           ('dropped', 'opcbridge_frames_dropped_total', 'counter', 'Frames skipped to catch up'),
+           ('targetfps', 'opcbridge_target_fps', 'gauge', 'Configured framerate'),
+           ('renderfps', 'opcbridge_render_fps', 'gauge', 'Framerate the render loop is currently scheduling'),
+           ('fps', 'opcbridge_fps', 'gauge', 'Achieved framerate'),
+           ('commands', 'opcbridge_commands_total', 'counter', 'Commands executed'),
+           ('commandspersec', 'opcbridge_commands_per_second', 'gauge', 'Commands executed per second'),
+           ('queuedepth', 'opcbridge_queue_depth', 'gauge', 'Commands waiting for the render loop'),
+           ('fadesinflight', 'opcbridge_fades_in_flight', 'gauge', 'Pixels with a fade running'),
+           ('effectsrunning', 'opcbridge_effects_running', 'gauge', 'Effects running'),
+           ('framessent', 'opcbridge_opc_frames_sent_total', 'counter', 'Frames sent to OPC servers'),
+           ('framesskipped', 'opcbridge_opc_frames_skipped_total', 'counter', 'Unchanged frames not sent'),
+           ('bytessent', 'opcbridge_opc_bytes_sent_total', 'counter', 'Pixel bytes sent to OPC servers'),
+           ('bytessaved', 'opcbridge_opc_bytes_saved_total', 'counter', 'Pixel bytes of unchanged frames not sent'),
+           ('opcreconnects', 'opcbridge_opc_reconnects_total', 'counter', 'OPC connections re-established'),
+           ('opcdropped', 'opcbridge_opc_dropped_total', 'counter', 'Frames an OPC server could not be sent'),
+           ('opcbusy', 'opcbridge_opc_busy_total', 'counter', 'Frames held back while an OPC server was busy'))
+
 class Renderer:
-    def __init__(self, frameRate, PSU=False):
+    def __init__(self, frameRate, PSU=False, pixelCount=512, channels=None, keepAlive=None, outputs=None, minFrameRate=None,
+                 correction=None):
+        #Number of pixels in the universe
+        self.pixelCount = pixelCount
         #Current value of pixels being submitted to opc
-        self.pixels = np.zeros((512, 3), dtype='float32')
-        #Differential array: stores difference between this frame and the next
-        self.diff = diff = np.zeros((512, 3), dtype='float32' )
+        self.pixels = np.zeros((pixelCount, 3), dtype='float32')
+        #Start values: where each pixel's current fade began
+        self.startVals = np.zeros((pixelCount, 3), dtype='float32')
         #End values: where the final frame should end up
-        self.endVals = np.zeros((512, 3), dtype='float32')
-        #Remaining number of frames for each pixel
-        self.remaining = np.zeros((512), dtype='uint16')
+        self.endVals = np.zeros((pixelCount, 3), dtype='float32')
+        #Times each pixel's current fade started and ends at, on the time.perf_counter clock.
+        #Every frame evaluates fades at the frame's time, so they end on time
+        #however many frames are rendered along the way
+        self.fadeStart = np.zeros((pixelCount), dtype='float64')
+        self.fadeEnd = np.zeros((pixelCount), dtype='float64')
+        #Pixels with a fade in flight
+        self.fading = np.zeros((pixelCount), dtype=bool)
+        #Index into CURVES of each pixel's current fade
+        self.curves = np.zeros((pixelCount), dtype=np.uint8)
+        #Lit bitmap: pixels that are on, or will be on while their fade runs
+        #Kept up to date as fades start and finish so PSUs never scan the pixels
+        self.lit = np.zeros((pixelCount), dtype=bool)
+        #Completed frames as 8 bit values, double buffered: the render loop
+        #fills the back buffer then swaps it to the front, where other threads
+        #read it. framesStarted counts buffer writes begun, frameNumber frames
+        #published, together they let readers detect a buffer being reused
+        self.front = np.zeros((pixelCount, 3), dtype=np.uint8)
+        self.back = np.zeros((pixelCount, 3), dtype=np.uint8)
+        self.framesStarted = 0
+        self.frameNumber = 0
+        #Command batch: fades queued in the same frame are merged here before being applied
+        self.batching = False
+        self.batchTargets = np.zeros((pixelCount, 3), dtype='float32')
+        self.batchTimes = np.zeros((pixelCount), dtype='float64')
+        self.batchCurves = np.zeros((pixelCount), dtype=np.uint8)
+        self.batchTouched = np.zeros((pixelCount), dtype=bool)
+        #Running effects: effect id -> Effect, composited over the pixels every frame
+        self.effects = {}
 
         #Used to sleep thread when there is no rendering to be done
         self.clockerActive = threading.Event()
         #Queue of commands to be executed
         #API handler thread produces commands, Render Loop consumes them
         self.commands = queue.Queue(maxsize=100)
-        #TODO: Make framerate and opcClient ip configurable
         self.frameRate = frameRate
-        self.opcClient = opc.Client('localhost:7890')
+        #Schedules frames and keeps frame time statistics
+        self.clock = FrameClock(frameRate, minFrameRate=minFrameRate)
+        #Time spent in each phase of a frame, encode and send are timed per output
+        self.timers = PhaseTimers(RENDER_PHASES)
+        #Commands executed since boot, and (frame start, commands) for recent frames
+        self.commandsExecuted = 0
+        self.commandCounts = collections.deque(maxlen=256)
+        #OPC servers the frame is sent to, each as a dict with a server address,
+        #an optional [start, stop) range of pixels and an optional channel map
+        #Without outputs, the whole frame goes to one local server using channels
+        if not outputs:
+            outputs = [{'server': 'localhost:7890', 'channels': channels}]
+        self.outputs = [Output(o['server'], o.get('pixels'), o.get('channels'), keepAlive) for o in outputs]
+        #Fail now rather than on every frame if an output's frames cannot be sent
+        for output in self.outputs:
+            output.checkLayout(pixelCount)
+        self.keepAlive = keepAlive
+        #Optional ColorCorrection applied to frames on their way to the outputs.
+        #Published frames, and so /pixels, keep the uncorrected values
+        self.correction = correction
+        #Sends run on worker threads, one per output, so a slow server only delays itself
+        self.sendPool = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.outputs))
         self.renderLoop = threading.Thread(target=self.render)
         self.renderLoop.daemon = True
-        self.PSU = PSU
+        #Off until switched on, samples the render loop's call stack
+        self.profiler = SamplingProfiler(self.renderLoop)
+        #PSUs to switch with the lights, either one PSU or a list of them
+        if not PSU:
+            PSU = []
+        elif not isinstance(PSU, (list, tuple)):
+            PSU = [PSU]
+        self.PSUs = list(PSU)
+
+    def fadeTo(self, indexes, rgb, times, curve=None, now=None):
+        '''Start fading the pixels in indexes towards rgb over times seconds,
+        from their values at now (the current time if not given).
+        rgb is either a single color or one color per index, times is either
+        a single fade time or one per index, and curve either a curve name
+        or an array of curve indexes, one per index.
+        While a command batch is open the fade is only recorded, later fades
+        to the same pixels replace earlier ones'''
+        indexes = np.asarray(indexes, dtype=np.intp).ravel()
+        rgb = np.asarray(rgb, dtype='float32')
+        times = np.asarray(times, dtype='float64')
+        if curve is None or isinstance(curve, str):
+            curve = curveIndex(curve)
+        if self.batching:
+            self.batchTargets[indexes] = rgb
+            self.batchTimes[indexes] = times
+            self.batchCurves[indexes] = curve
+            self.batchTouched[indexes] = True
+            return
+        if now is None:
+            now = time.perf_counter()
+        current = self.valueAt(indexes, now)
+        self.startVals[indexes] = current
+        self.fadeStart[indexes] = now
+        self.fadeEnd[indexes] = now + times
+        self.fading[indexes] = True
+        self.endVals[indexes] = rgb
+        self.curves[indexes] = curve
+        self.lit[indexes] = np.any(current > 0, axis=1) | np.any(self.endVals[indexes] > 0, axis=1)
+
+    def applyBatch(self, now=None):
+        '''Close the command batch and start every fade recorded in it at once'''
+        self.batching = False
+        indexes = np.flatnonzero(self.batchTouched)
+        if not len(indexes):
+            return
+        self.batchTouched[indexes] = False
+        self.fadeTo(indexes, self.batchTargets[indexes], self.batchTimes[indexes], self.batchCurves[indexes], now)
+
+    def progress(self, indexes, now):
+        '''Fraction of the fade on each pixel in indexes completed at now'''
+        span = self.fadeEnd[indexes] - self.fadeStart[indexes]
+        progress = np.divide(now - self.fadeStart[indexes], span, out=np.ones_like(span), where=span > 0)
+        return np.clip(progress, 0, 1)
+
+    def valueAt(self, indexes, now):
+        '''Values of the pixels in indexes at now: fades in flight are
+        evaluated at now, other pixels keep their current value'''
+        values = self.pixels[indexes]
+        fading = self.fading[indexes]
+        if fading.any():
+            moving = indexes[fading]
+            values[fading] = ease(self.startVals[moving], self.endVals[moving],
+                                  self.progress(moving, now), self.curves[moving])
+        return values
+
+    def targets(self, indexes):
+        '''Values the pixels in indexes are heading to: the target of a fade
+        recorded in the open command batch, else the end of the fade in
+        flight, else their current value'''
+        values = self.pixels[indexes]
+        fading = self.fading[indexes]
+        values[fading] = self.endVals[indexes[fading]]
+        if self.batching:
+            touched = self.batchTouched[indexes]
+            values[touched] = self.batchTargets[indexes[touched]]
+        return values
+
+    def addEffect(self, effectID, effect):
+        '''Start compositing an effect. Fades on its pixels are cancelled,
+        the effect owns them until it is stopped'''
+        self.fading[effect.indexes] = False
+        self.effects[effectID] = effect
+
+    def removeEffect(self, effectID):
+        '''Stop an effect, its pixels keep their last values'''
+        self.effects.pop(effectID, None)
+
+    def renderEffects(self):
+        '''Write the next frame of every running effect into the pixels.
+        Returns True if any effects are running. Effects that finish or fail
+        are removed, their pixels keep their last values'''
+        for effectID, effect in list(self.effects.items()):
+            try:
+                values = next(effect.frames)
+            except StopIteration:
+                del self.effects[effectID]
+                continue
+            except Exception as e:
+                logError('Effect %s (%s) failed, stopping it: %s' % (effectID, effect.name, e))
+                del self.effects[effectID]
+                continue
+            self.pixels[effect.indexes] = values
+            self.lit[effect.indexes] = np.any(values > 0, axis=1)
+        return bool(self.effects)
+
+    def interpolate(self, now=None):
+        '''Set every fading pixel to its value at now (the current time if not
+        given), evaluating its curve for the fraction of the fade completed.
+        Pixels whose fade has ended snap to their end value and have their lit
+        state updated. Returns True if any pixel was still fading at the start
+        of the frame'''
+        active = np.flatnonzero(self.fading)
+        if not len(active):
+            return False
+        if now is None:
+            now = time.perf_counter()
+        progress = self.progress(active, now)
+        self.pixels[active] = ease(self.startVals[active], self.endVals[active], progress, self.curves[active])
+        done = active[progress >= 1]
+        self.pixels[done] = self.endVals[done]
+        self.fading[done] = False
+        self.lit[done] = np.any(self.endVals[done] > 0, axis=1)
+        return True
 
-    def absoluteFade(self, rgb, indexes, fadeTime):
+    def absoluteFade(self, rgb, indexes, fadeTime, curve=None):
         '''Take pixels marked in indexes and fade them to value in rgb over
-        fadeTime amount of time'''
-        #If the fadeTime is 0, we still want at least 2 frames
-        #If only one frame, the interpolation engine will produce slow fade
-        if not fadeTime:
-            fadeTime = 2 / self.frameRate
-        frames = int(fadeTime * self.frameRate)
-        for i in indexes:
-            self.remaining[i] = frames
-            for c in range(3):
-                self.diff[i][c] = (rgb[c] - self.pixels[i][c]) / frames
-            self.endVals[i] = rgb
+        fadeTime amount of time, following curve'''
+        self.fadeTo(indexes, rgb, fadeDuration(fadeTime), curve)
 
     def multiCommand(self, commandList):
-        '''Multicommand format: [indexes, rgb value, fadetime]
+        '''Multicommand format: [indexes, rgb value, fadetime] or [indexes, rgb value, fadetime, curve]
         allows for multiple different pixels to be set to multiple different values
         this is more efficent than stringing individual commands together'''
-        for x in commandList:
-            #Which pixels are being controlled?
-            indexes = x[0]
-            #How much time does it take to complete?
-            frames = int(x[2] * self.frameRate)
-            if not frames:
-                frames = 2
-            #What color are we fading to?
-            rgb = x[1]
-            for i in indexes:
-                self.remaining[i] = frames
-                for c in range(3):
-                    self.diff[i][c] = (rgb[c] - self.pixels[i][c]) / frames
-                self.endVals[i] = rgb
-
-    def relativeFade(self, magnitude, indexes, fadeTime):
-        '''fade value up or down relative to current pixel values'''
-        commandList = []
-        for i in indexes:
-            endVal = brightnessChange(self.pixels[i], magnitude)
-            commandList.append([[i], endVal, fadeTime])
-        self.multiCommand(commandList)
-
-    def executeCommands(self):
-        '''Take all commands out of command queue and execute them'''
-        if self.PSU and not self.commands.empty():
-            self.PSU.update(self.pixels)
-        while not self.commands.empty():
-            newCommand, args = self.commands.get()
-            try:
-                newCommand(*args)
-            except Exception as e:
-                print('Command failed!')
-                logError(str(e))
+        if not commandList:
+            return
+        self.fadeTo(*flattenCommands(commandList))
+
+    def applyScene(self, scene):
+        '''Start every fade of a compiled scene at once'''
+        self.fadeTo(scene.indexes, scene.targets, scene.times, scene.curves)
+
+    def relativeFade(self, magnitude, indexes, fadeTime, curve=None):
+        '''Fade value up or down relative to where each pixel is heading, so a
+        relative fade sent during another fade adjusts that fade's end value'''
+        indexes = np.asarray(indexes, dtype=np.intp).ravel()
+        endVals = brightnessChangeArray(self.targets(indexes), magnitude)
+        self.fadeTo(indexes, endVals, fadeDuration(fadeTime), curve)
+
+    def submit(self, command, args, timeout=0):
+        '''Queue a command for the render loop, waiting at most timeout seconds
+        for room. Returns False if the queue stayed full so the caller can
+        report back-pressure'''
+        try:
+            self.commands.put((command, args), block=bool(timeout), timeout=timeout or None)
+        except queue.Full:
+            return False
+        self.clockerActive.set()
+        return True
+
+    def publishFrame(self):
+        '''Write the current pixel values into the back buffer as 8 bit values
+        and swap it to the front'''
+        self.framesStarted += 1
+        np.clip(self.pixels, 0, 255, out=self.back, casting='unsafe')
+        self.front, self.back = self.back, self.front
+        self.frameNumber += 1
+
+    def snapshot(self, start=None, stop=None):
+        '''Immutable copy of the last published frame, optionally limited to
+        the index range [start, stop). Never waits on the render loop: a front
+        buffer is only rewritten two publishes after it was swapped in, so the
+        copy is retried in the rare case that happened while it was taken'''
+        while True:
+            number = self.frameNumber
+            frame = self.front[start:stop].copy()
+            if self.framesStarted <= number + 1:
+                frame.flags.writeable = False
+                return frame
+
+    def sendFrame(self, frame):
+        '''Hand an 8 bit frame to every output. Outputs still busy sending the
+        previous frame hold this one back, to send once they are done unless
+        a newer frame replaces it. Outputs whose slice is unchanged and have
+        no keepalive due skip it. Returns the number of outputs sent to'''
+        now = time.monotonic()
+        sending = 0
+        for output in self.outputs:
+            #Copied, the frame buffer will be reused while the send is in flight
+            piece = frame[output.start:output.stop]
+            with output.lock:
+                if output.pending is not None and not output.pending.done():
+                    output.waiting = (piece.copy(), now)
+                    output.framesBusy += 1
+                    continue
+                if not output.due(piece, now):
+                    continue
+                output.pending = self.sendPool.submit(self.sendOutput, output, piece.copy(), now)
+            sending += 1
+        return sending
+
+    def sendOutput(self, output, frame, now):
+        '''Send a frame to one output from a send pool thread, timing the
+        encode and the socket write, then send the frame held back while it
+        ran, if any. Returns whether the last send succeeded'''
+        while True:
+            sent = output.send(frame, now)
+            if sent:
+                self.timers.record('encode', output.client.encode_time)
+                self.timers.record('send', output.client.send_time)
+            else:
+                #The render loop retries failed frames, wake it if it went to sleep
+                self.clockerActive.set()
+            with output.lock:
+                waiting, output.waiting = output.waiting, None
+                if waiting is None or not output.due(*waiting):
+                    #Cleared under the lock, so sendFrame never holds a frame
+                    #back for a worker that is already finishing
+                    output.pending = None
+                    return sent
+            frame, now = waiting
+
+    def outputsBehind(self):
+        '''True while any output's last send failed, so its frame has to be retried'''
+        return any(output.failed for output in self.outputs)
+
+    def flushOutputs(self, timeout=None):
+        '''Wait for sends in flight, and the frames held back behind them, to finish'''
+        pending = [output.pending for output in self.outputs if output.pending is not None]
+        concurrent.futures.wait(pending, timeout)
+
+    def channelOffset(self, channel):
+        '''Pixel index an OPC channel starts at, taken from the first output
+        that maps it. Channel 0 starts at pixel 0'''
+        if not channel:
+            return 0
+        for output in self.outputs:
+            first = output.client.channel_offset(channel)
+            if first is not None:
+                return output.start + first
+        return None
+
+    def commandRate(self):
+        '''Commands executed per second over recent frames'''
+        counts = list(self.commandCounts)
+        if len(counts) < 2 or counts[-1][0] <= counts[0][0]:
+            return 0
+        return sum(count for start, count in counts[1:]) / (counts[-1][0] - counts[0][0])
+
+    def stats(self):
+        '''Frame timing statistics along with OPC output counters, summed over
+        outputs, command counters and the timing of each phase of a frame'''
+        stats = self.clock.stats()
+        stats.update({'commands': self.commandsExecuted,
+                      'commandspersec': round(self.commandRate(), 2),
+                      'queuedepth': self.commands.qsize(),
+                      'fadesinflight': int(np.count_nonzero(self.fading)),
+                      'effectsrunning': len(self.effects)})
+        stats.update({'framessent': sum(o.framesSent for o in self.outputs),
+                      'framesskipped': sum(o.framesSkipped for o in self.outputs),
+                      'bytessent': sum(o.bytesSent for o in self.outputs),
+                      'bytessaved': sum(o.bytesSaved for o in self.outputs),
+                      'opcreconnects': sum(o.client.reconnects for o in self.outputs),
+                      'opcdropped': sum(o.client.dropped_frames for o in self.outputs),
+                      'opcbusy': sum(o.framesBusy for o in self.outputs)})
+        stats['phases'] = self.timers.stats()
+        return stats
+
+    def metrics(self):
+        '''Statistics in the Prometheus text exposition format'''
+        stats = self.stats()
+        lines = []
+        for key, name, kind, help in METRICS:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s %s' % (name, stats[key]))
+        lines.append('# HELP opcbridge_phase_seconds Time spent in each phase of a frame')
+        lines.append('# TYPE opcbridge_phase_seconds summary')
+        for phase, times in stats['phases'].items():
+            lines.append('opcbridge_phase_seconds{phase="%s",quantile="0.5"} %g' % (phase, times['p50ms'] / 1000))
+            lines.append('opcbridge_phase_seconds{phase="%s",quantile="0.99"} %g' % (phase, times['p99ms'] / 1000))
+            lines.append('opcbridge_phase_seconds_sum{phase="%s"} %g' % (phase, self.timers.totals[phase]))
+            lines.append('opcbridge_phase_seconds_count{phase="%s"} %d' % (phase, self.timers.counts[phase]))
+        return '\n'.join(lines) + '\n'
+
+    def updatePSUs(self):
+        '''Switch each PSU on or off depending on whether its pixels are lit'''
+        for psu in self.PSUs:
+            psu.update(self.lit)
+
+    def executeCommands(self, now=None):
+        '''Take all commands out of command queue and execute them.
+        Pixel values do not change between commands in the same frame, so the
+        fades are coalesced into one batch and applied in a single pass, all
+        starting at now. Returns the number of commands taken'''
+        self.batching = True
+        executed = 0
+        try:
+            while not self.commands.empty():
+                newCommand, args = self.commands.get()
+                executed += 1
+                try:
+                    newCommand(*args)
+                except Exception as e:
+                    logError('Command failed! %s' % e)
+        finally:
+            self.applyBatch(now)
+            self.commandsExecuted += executed
+        return executed
+
+    def renderFrame(self, steps=1, now=None):
+        '''Run commands, evaluate fades at now (the start of the frame if not
+        given), advance effects by steps frames and send the result, timing
+        each phase. Returns whether anything is still moving'''
+        frameStart = time.perf_counter()
+        if now is None:
+            now = frameStart
+        executed = self.executeCommands(now)
+        lap = self.timers.lap('commands', frameStart)
+        anyRemaining = self.interpolate(now)
+        lap = self.timers.lap('interpolate', lap)
+        #Effects render a frame at a time, when frames are merged they are stepped to catch up
+        for step in range(steps):
+            anyRemaining = self.renderEffects() or anyRemaining
+        lap = self.timers.lap('effects', lap)
+        self.updatePSUs()
+        lap = self.timers.lap('psu', lap)
+        self.publishFrame()
+        lap = self.timers.lap('publish', lap)
+        frame = self.front
+        if self.correction is not None:
+            frame = self.correction.apply(self.pixels)
+            #Dithered values only average out while frames keep coming
+            anyRemaining = self.correction.active or anyRemaining
+        lap = self.timers.lap('correct', lap)
+        self.sendFrame(frame)
+        #Keep rendering while an output has a failed frame to retry
+        anyRemaining = self.outputsBehind() or anyRemaining
+        self.timers.lap('dispatch', lap)
+        self.clock.record(frameStart, time.perf_counter() - frameStart)
+        self.commandCounts.append((frameStart, executed))
+        return anyRemaining
 
     def render(self):
         '''Primary rendering loop, takes commands from API handler at start and
         submits frames at end'''
-        print('Initiating Render Loop...')
+        logger.info('Initiating Render Loop...')
+        self.clock.reset()
+        steps = 1
+        sleeping = False
         while True:
-            now = time.perf_counter()
-            self.executeCommands()
-            anyRemaining = False
-            for pix in range(512):
-                if not self.remaining[pix]:
-                    pass
-                elif self.remaining[pix] > 1:
-                    for i in range(3):
-                        self.pixels[pix][i] += self.diff[pix][i]
-                    self.remaining[pix] -= 1
-                    anyRemaining = True
-                elif self.remaining[pix] == 1:
-                    self.pixels[pix] = self.endVals[pix]
-                    self.remaining[pix] -= 1
-                    anyRemaining = True
-            try:
-                self.opcClient.put_pixels(self.pixels)
-            except Exception as e:
-                print('Unable to contact opc Client')
-            cycleTime = time.perf_counter() - now
-            time.sleep(max((1 / self.frameRate) - cycleTime, 0))
+            anyRemaining = self.renderFrame(steps)
             if not anyRemaining:
-                if self.PSU:
-                    self.PSU.update(self.pixels)
-                if self.commands.empty():
-                    self.clockerActive.clear()
-                    print('Sleeping render loop...')
-            self.clockerActive.wait()
+                self.clockerActive.clear()
+                #A command may have arrived while we were checking
+                if not self.commands.empty():
+                    self.clockerActive.set()
+                elif not sleeping:
+                    logger.info('Sleeping render loop...')
+            sleeping = not self.clockerActive.is_set()
+            if sleeping:
+                #With a keepalive, wake up to resend the last frame for controllers that need it
+                self.clockerActive.wait(self.keepAlive)
+                self.clock.reset()
+                steps = 1
+            else:
+                steps = self.clock.wait()
 
 
-if __name__ == '__main__':
-    #########################LOAD IN USER CONFIG####################################
-    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opcConfig.yml')) as f:
-        configFile = f.read()
-    configs = yaml.safe_load(configFile)
+##########################STREAMING INGEST######################################
+#Persistent TCP channel speaking Open Pixel Control framing:
+#channel (1 byte), command (1 byte), data length (2 bytes big endian), data
+#Command 0 sets pixel colors as RGB triplets, starting at the first pixel of the
+#channel (channel 0 starts at pixel 0). Extended fade commands are sent as OPC
+#system exclusive messages (command 255) with STREAM_SYSTEM_ID and a subcommand
+#byte, every fade then starts with its fade time as a big endian float32:
+#  STREAM_ABSOLUTE_FADE: rgb (3 bytes), then uint16 pixel indexes
+#  STREAM_RELATIVE_FADE: int16 magnitude, then uint16 pixel indexes
+#  STREAM_RANGE_FADE: uint16 first pixel index, then RGB triplets
+OPC_SET_PIXELS = 0
+OPC_SYSTEM_EXCLUSIVE = 255
+STREAM_SYSTEM_ID = 0x4f42
+STREAM_ABSOLUTE_FADE = 1
+STREAM_RELATIVE_FADE = 2
+STREAM_RANGE_FADE = 3
 
+def streamMessage(subcommand, fadeTime, body, channel=0):
+    '''Build an extended fade message for the streaming channel'''
+    data = struct.pack('>HBf', STREAM_SYSTEM_ID, subcommand, fadeTime) + body
+    return struct.pack('>BBH', channel, OPC_SYSTEM_EXCLUSIVE, len(data)) + data
 
-    ##################SERVER LOGGING AND REPORTING FUNCTIONS########################
-    def logError(err):
-        print(err)
-        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opcBridge-log.txt'), 'a') as logFile:
-            logFile.write(err)
-            logFile.write('\n')
+def streamAbsoluteFade(rgb, indexes, fadeTime):
+    return streamMessage(STREAM_ABSOLUTE_FADE, fadeTime,
+                         bytes(rgb) + np.asarray(indexes, dtype='>u2').tobytes())
+
+def streamRelativeFade(magnitude, indexes, fadeTime):
+    return streamMessage(STREAM_RELATIVE_FADE, fadeTime,
+                         struct.pack('>h', magnitude) + np.asarray(indexes, dtype='>u2').tobytes())
+
+def streamRangeFade(first, pixels, fadeTime):
+    return streamMessage(STREAM_RANGE_FADE, fadeTime,
+                         struct.pack('>H', first) + np.asarray(pixels, dtype=np.uint8).tobytes())
+
+class StreamHandler(socketserver.StreamRequestHandler):
+    '''Reads OPC framed messages from one client connection and feeds them
+    straight into the renderer's command queue'''
+    def handle(self):
+        renderer = self.server.renderer
+        while True:
+            header = self.rfile.read(4)
+            if len(header) < 4:
+                return
+            channel, command, length = struct.unpack('>BBH', header)
+            data = self.rfile.read(length)
+            if len(data) < length:
+                return
+            try:
+                parsed = self.parse(renderer, channel, command, data)
+            except (ValueError, struct.error) as e:
+                logger.warning('Bad stream message from %s: %s', self.client_address[0], e)
+                continue
+            if parsed:
+                #Wait as long as it takes for room in the queue, while this thread
+                #stops reading the client is pushed back through TCP
+                while not renderer.submit(parsed[0], parsed[1], timeout=1):
+                    pass
 
-    bootMsg = 'Server booted at ' + str(datetime.datetime.now()) + '\n'
-    logError(bootMsg)
+    def parse(self, renderer, channel, command, data):
+        '''Turn one message into a (command, args) pair for the renderer'''
+        if command == OPC_SET_PIXELS:
+            first = 0
+            if channel:
+                first = renderer.channelOffset(channel)
+                if first is None:
+                    return None
+            rgb = np.frombuffer(data, dtype=np.uint8)[:len(data) // 3 * 3].reshape(-1, 3)
+            return self.fade(renderer, np.arange(first, first + len(rgb)), rgb, 0)
+        if command != OPC_SYSTEM_EXCLUSIVE or len(data) < 7:
+            return None
+        systemID, subcommand, fadeTime = struct.unpack_from('>HBf', data)
+        if systemID != STREAM_SYSTEM_ID:
+            return None
+        body = data[7:]
+        if subcommand == STREAM_ABSOLUTE_FADE:
+            rgb = np.frombuffer(body[:3], dtype=np.uint8)
+            indexes = np.frombuffer(body[3:], dtype='>u2')
+            return self.fade(renderer, indexes, rgb, fadeTime)
+        if subcommand == STREAM_RELATIVE_FADE:
+            magnitude, = struct.unpack_from('>h', body)
+            indexes = self.valid(renderer, np.frombuffer(body[2:], dtype='>u2'))
+            return renderer.relativeFade, [magnitude, indexes, fadeTime]
+        if subcommand == STREAM_RANGE_FADE:
+            first, = struct.unpack_from('>H', body)
+            rgb = np.frombuffer(body[2:], dtype=np.uint8)[:(len(body) - 2) // 3 * 3].reshape(-1, 3)
+            return self.fade(renderer, np.arange(first, first + len(rgb)), rgb, fadeTime)
+        raise ValueError('unknown subcommand %d' % subcommand)
 
-    psu = PSU(configs['PSUs']['ip'], configs['PSUs']['index'], port=configs['PSUs']['port'])
-    renderer = Renderer(configs['framerate'], PSU=psu)
+    def valid(self, renderer, indexes):
+        '''Drop indexes that fall outside the universe'''
+        return indexes[indexes < renderer.pixelCount]
 
+    def fade(self, renderer, indexes, rgb, fadeTime):
+        keep = indexes < renderer.pixelCount
+        if rgb.ndim > 1:
+            rgb = rgb[keep]
+        return renderer.fadeTo, [indexes[keep], rgb, fadeDuration(fadeTime)]
 
+class StreamServer(socketserver.ThreadingTCPServer):
+    '''TCP listener for the streaming ingest channel, one thread per client'''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, renderer):
+        socketserver.ThreadingTCPServer.__init__(self, address, StreamHandler)
+        self.renderer = renderer
+
+
+#############################REST API###########################################
+def createFlaskServer(renderer, scenes):
+    '''Build the Flask application serving the REST API for renderer, with
+    scenes stored in the given SceneLibrary'''
     flaskServer = Flask(__name__)
     api = Api(flaskServer)
 
-    localIP = getLocalIP()
-    port = 8000
     arbitration = [False, '127.0.0.1']
     parser = reqparse.RequestParser()
 
@@ -251,13 +1288,30 @@ if __name__ == '__main__':
     parser.add_argument('rgb', type=json.loads, help='Target color')
     parser.add_argument('magnitude', type=float, help='Size of fade')
     parser.add_argument('commandlist', type=json.loads, help='List of commands for a multicommand')
+    parser.add_argument('curve', type=str, choices=CURVES, help='Shape of the fade')
+    parser.add_argument('effect', type=str, choices=sorted(effects.EFFECTS), help='Name of effect to start')
+    parser.add_argument('params', type=json.loads, help='Effect parameters')
+    parser.add_argument('name', type=str, help='Scene name')
+    parser.add_argument('format', type=str, choices=PIXEL_FORMATS, help='Encoding of returned pixels')
+    parser.add_argument('start', type=int, help='First pixel index returned')
+    parser.add_argument('stop', type=int, help='Pixel index to stop before')
+    parser.add_argument('interval', type=float, help='Seconds between profiler samples')
+
+    #Ids handed out to started effects
+    effectIDs = itertools.count(1)
+    #Response when the render loop cannot keep up with incoming commands
+    queueFull = ({'message': 'Render queue is full, retry shortly'}, 503)
 
     ###################COMMAND TYPE HANDLING########################################
     class Pixels(Resource):
         def get(self):
-            '''Gives the entire pixel array back to the client as a 512 * 3 array'''
-            print('\nSending pixels to %s \n' % request.remote_addr)
-            message = pixelsToJson(pixels)
+            '''Gives the pixel array back to the client as a pixelCount * 3 array,
+            or the [start, stop) range of it, encoded as requested'''
+            args = parser.parse_args()
+            fmt = args['format'] or 'json'
+            message = encodePixels(renderer.snapshot(args['start'], args['stop']), fmt)
+            if fmt == 'raw':
+                return Response(message, mimetype='application/octet-stream')
             return message
 
     class Arbitration(Resource):
@@ -265,7 +1319,7 @@ if __name__ == '__main__':
             args = parser.parse_args()
             id = args['id']
             ip = request.remote_addr
-            print('\nGiving arbitration to %s from %s\n' % (id, ip))
+            logger.info('Giving arbitration to %s from %s', id, ip)
             arbitration[0] = id
             arbitration[1] = ip
 
@@ -273,7 +1327,7 @@ if __name__ == '__main__':
             args = parser.parse_args()
             id = args['id']
             ip = request.remote_addr
-            print('\nSending arbitration to %s for %s\n' % (ip, id))
+            logger.info('Sending arbitration to %s for %s', ip, id)
             if id != arbitration[0]:
                 return False
             elif ip != arbitration[1]:
@@ -288,8 +1342,9 @@ if __name__ == '__main__':
             fadeTime = args['fadetime']
             rgb = args['rgb']
             indexes = args['indexes']
-            renderer.commands.put((renderer.absoluteFade, [rgb, indexes, fadeTime]))
-            renderer.clockerActive.set()
+            curve = args['curve']
+            if not renderer.submit(renderer.absoluteFade, [rgb, indexes, fadeTime, curve]):
+                return queueFull
 
     class MultiCommand(Resource):
         '''Is given a list of indexes, associated values and fade times
@@ -298,8 +1353,8 @@ if __name__ == '__main__':
         def get(self):
             args = parser.parse_args()
             commandList = args['commandlist']
-            renderer.commands.put((renderer.multiCommand, [commandList]))
-            renderer.clockerActive.set()
+            if not renderer.submit(renderer.multiCommand, [commandList]):
+                return queueFull
 
     class RelativeFade(Resource):
         '''Is given a brightness change, and alters the brightness, likely unpredicatable
@@ -309,35 +1364,477 @@ if __name__ == '__main__':
             indexes = args['indexes']
             magnitude = args['magnitude']
             fadeTime = args['fadetime']
-            renderer.commands.put((renderer.relativeFade, [magnitude, indexes, fadeTime]))
-            renderer.clockerActive.set()
+            curve = args['curve']
+            if not renderer.submit(renderer.relativeFade, [magnitude, indexes, fadeTime, curve]):
+                return queueFull
+
+    class Effects(Resource):
+        '''Starts and stops effects that are rendered on the server every frame'''
+        def get(self):
+            '''Lists running effects by id'''
+            return {effectID: effect.describe() for effectID, effect in dict(renderer.effects).items()}
+
+        def put(self):
+            '''Starts an effect on the given indexes, returns its id'''
+            args = parser.parse_args()
+            indexes = args['indexes']
+            if indexes is None:
+                indexes = range(renderer.pixelCount)
+            try:
+                effect = Effect(args['effect'], indexes, renderer.frameRate, args['params'])
+                if len(effect.indexes) and not 0 <= effect.indexes.min() <= effect.indexes.max() < renderer.pixelCount:
+                    raise IndexError('indexes must be between 0 and %d' % (renderer.pixelCount - 1))
+                #Run the first frame here so bad parameters are reported to the client
+                next(effect.frames)
+            except (TypeError, ValueError, IndexError) as e:
+                return {'message': 'Could not start effect: %s' % e}, 400
+            effectID = str(next(effectIDs))
+            if not renderer.submit(renderer.addEffect, [effectID, effect]):
+                return queueFull
+            return {'id': effectID}
+
+        def delete(self):
+            '''Stops the effect with the given id'''
+            args = parser.parse_args()
+            if not renderer.submit(renderer.removeEffect, [args['id']]):
+                return queueFull
+
+    class Scenes(Resource):
+        '''Named multicommands stored on the server, recalled with a single call'''
+        def get(self):
+            '''Recalls the named scene, or lists scene names if no name is given'''
+            args = parser.parse_args()
+            name = args['name']
+            if name is None:
+                return scenes.names()
+            try:
+                scene = scenes.get(name)
+            except KeyError:
+                return {'message': 'No scene named %s' % name}, 404
+            except (TypeError, ValueError, IndexError) as e:
+                return {'message': 'Scene %s is invalid: %s' % (name, e)}, 500
+            if not renderer.submit(renderer.applyScene, [scene]):
+                return queueFull
+
+        def put(self):
+            '''Stores a commandlist under the given name'''
+            args = parser.parse_args()
+            try:
+                scenes.save(args['name'], args['commandlist'])
+            except (TypeError, ValueError, IndexError) as e:
+                return {'message': 'Could not store scene: %s' % e}, 400
+
+        def delete(self):
+            args = parser.parse_args()
+            try:
+                scenes.delete(args['name'])
+            except KeyError:
+                return {'message': 'No scene named %s' % args['name']}, 404
+
+    class Stats(Resource):
+        '''Rolling render loop statistics: achieved fps, frame times, late and dropped frames'''
+        def get(self):
+            return renderer.stats()
+
+    class Metrics(Resource):
+        '''Render loop statistics for Prometheus to scrape'''
+        def get(self):
+            return Response(renderer.metrics(), content_type=METRICS_CONTENT_TYPE)
+
+    class Profile(Resource):
+        '''Switches the render loop's sampling profiler on and off, and reports what it found'''
+        def get(self):
+            return renderer.profiler.report()
+
+        def put(self):
+            args = parser.parse_args()
+            renderer.profiler.start(args['interval'])
+
+        def delete(self):
+            renderer.profiler.stop()
 
     api.add_resource(Pixels, '/pixels')
     api.add_resource(Arbitration, '/arbitration')
     api.add_resource(AbsoluteFade, '/absolutefade')
     api.add_resource(MultiCommand, '/multicommand')
     api.add_resource(RelativeFade, '/relativefade')
+    api.add_resource(Effects, '/effects')
+    api.add_resource(Scenes, '/scenes')
+    api.add_resource(Stats, '/stats')
+    api.add_resource(Metrics, '/metrics')
+    api.add_resource(Profile, '/profile')
+
+    return flaskServer
+
+############################ASYNC SERVER########################################
+#Argument converters for the async server. Query string and form values arrive
+#as text, values from a JSON body already have their type
+def jsonArgument(value):
+    return json.loads(value) if isinstance(value, str) else value
 
-    psu.switch(True)
+def choiceArgument(choices):
+    def convert(value):
+        if value not in choices:
+            raise ValueError('%s is not one of %s' % (value, ', '.join(choices)))
+        return value
+    return convert
+
+#Argument name -> (converter, help), matching the Flask parser
+ASYNC_ARGUMENTS = {'fadetime': (float, 'How long will this fade take?'),
+                   'indexes': (jsonArgument, 'Which pixels are targeted'),
+                   'id': (str, 'Arbtration ID'),
+                   'rgb': (jsonArgument, 'Target color'),
+                   'magnitude': (float, 'Size of fade'),
+                   'commandlist': (jsonArgument, 'List of commands for a multicommand'),
+                   'curve': (choiceArgument(CURVES), 'Shape of the fade'),
+                   'effect': (choiceArgument(sorted(effects.EFFECTS)), 'Name of effect to start'),
+                   'params': (jsonArgument, 'Effect parameters'),
+                   'name': (str, 'Scene name'),
+                   'format': (choiceArgument(PIXEL_FORMATS), 'Encoding of returned pixels'),
+                   'start': (int, 'First pixel index returned'),
+                   'stop': (int, 'Pixel index to stop before'),
+                   'interval': (float, 'Seconds between profiler samples')}
+
+class AsyncServer:
+    '''The REST API served from one asyncio event loop instead of a thread per
+    request. Each route only converts the arguments it uses and checks them
+    before anything is queued, commands are handed to the renderer without
+    waiting. Routes that touch the disk run on the default executor.
+    Instances are also ASGI applications, so they can be hosted by an ASGI
+    server instead of the built in HTTP/1.1 server'''
+    def __init__(self, renderer, scenes):
+        self.renderer = renderer
+        self.scenes = scenes
+        self.arbitration = [False, '127.0.0.1']
+        self.effectIDs = itertools.count(1)
+        #(method, path) -> (handler, arguments used, runs on executor)
+        self.routes = {('GET', '/pixels'): (self.getPixels, ('format', 'start', 'stop'), False),
+                       ('GET', '/arbitration'): (self.getArbitration, ('id',), False),
+                       ('PUT', '/arbitration'): (self.putArbitration, ('id',), False),
+                       ('GET', '/absolutefade'): (self.absoluteFade, ('rgb', 'indexes', 'fadetime', 'curve'), False),
+                       ('GET', '/multicommand'): (self.multiCommand, ('commandlist',), False),
+                       ('GET', '/relativefade'): (self.relativeFade, ('magnitude', 'indexes', 'fadetime', 'curve'), False),
+                       ('GET', '/effects'): (self.getEffects, (), False),
+                       ('PUT', '/effects'): (self.putEffect, ('effect', 'indexes', 'params'), False),
+                       ('DELETE', '/effects'): (self.deleteEffect, ('id',), False),
+                       ('GET', '/scenes'): (self.getScene, ('name',), True),
+                       ('PUT', '/scenes'): (self.putScene, ('name', 'commandlist'), True),
+                       ('DELETE', '/scenes'): (self.deleteScene, ('name',), True),
+                       ('GET', '/stats'): (self.getStats, (), False),
+                       ('GET', '/metrics'): (self.getMetrics, (), False),
+                       ('GET', '/profile'): (self.getProfile, (), False),
+                       ('PUT', '/profile'): (self.putProfile, ('interval',), False),
+                       ('DELETE', '/profile'): (self.deleteProfile, (), True)}
+
+    def indexes(self, indexes):
+        '''Indexes as an array, raising IndexError if any fall outside the universe'''
+        indexes = np.asarray(indexes, dtype=np.intp).ravel()
+        if len(indexes) and not 0 <= indexes.min() <= indexes.max() < self.renderer.pixelCount:
+            raise IndexError('indexes must be between 0 and %d' % (self.renderer.pixelCount - 1))
+        return indexes
+
+    def queue(self, command, args):
+        if not self.renderer.submit(command, args):
+            return {'message': 'Render queue is full, retry shortly'}, 503
+        return None, 200
+
+    def getPixels(self, client, args):
+        fmt = args['format'] or 'json'
+        message = encodePixels(self.renderer.snapshot(args['start'], args['stop']), fmt)
+        if fmt == 'raw':
+            return message, 200, 'application/octet-stream'
+        return message, 200
+
+    def getArbitration(self, client, args):
+        return args['id'] == self.arbitration[0] and client == self.arbitration[1], 200
+
+    def putArbitration(self, client, args):
+        logger.info('Giving arbitration to %s from %s', args['id'], client)
+        self.arbitration[0] = args['id']
+        self.arbitration[1] = client
+        return None, 200
+
+    def absoluteFade(self, client, args):
+        rgb = np.asarray(args['rgb'], dtype='float32')
+        if rgb.shape != (3,):
+            raise ValueError('rgb must be 3 values')
+        indexes = self.indexes(args['indexes'])
+        return self.queue(self.renderer.fadeTo, [indexes, rgb, fadeDuration(args['fadetime']), args['curve']])
+
+    def multiCommand(self, client, args):
+        if not args['commandlist']:
+            return None, 200
+        #Flattened here, so the render loop only has to apply the result
+        indexes, rgb, times, curves = flattenCommands(args['commandlist'])
+        return self.queue(self.renderer.fadeTo, [self.indexes(indexes), rgb, times, curves])
+
+    def relativeFade(self, client, args):
+        if args['magnitude'] is None:
+            raise ValueError('magnitude is required')
+        indexes = self.indexes(args['indexes'])
+        return self.queue(self.renderer.relativeFade, [args['magnitude'], indexes, args['fadetime'], args['curve']])
+
+    def getEffects(self, client, args):
+        return {effectID: effect.describe() for effectID, effect in dict(self.renderer.effects).items()}, 200
+
+    def putEffect(self, client, args):
+        indexes = args['indexes']
+        if indexes is None:
+            indexes = range(self.renderer.pixelCount)
+        effect = Effect(args['effect'], self.indexes(indexes), self.renderer.frameRate, args['params'])
+        #Run the first frame here so bad parameters are reported to the client
+        next(effect.frames)
+        effectID = str(next(self.effectIDs))
+        response = self.queue(self.renderer.addEffect, [effectID, effect])
+        if response[1] != 200:
+            return response
+        return {'id': effectID}, 200
+
+    def deleteEffect(self, client, args):
+        return self.queue(self.renderer.removeEffect, [args['id']])
+
+    def getScene(self, client, args):
+        name = args['name']
+        if name is None:
+            return self.scenes.names(), 200
+        try:
+            scene = self.scenes.get(name)
+        except KeyError:
+            return {'message': 'No scene named %s' % name}, 404
+        except (TypeError, ValueError, IndexError) as e:
+            return {'message': 'Scene %s is invalid: %s' % (name, e)}, 500
+        return self.queue(self.renderer.applyScene, [scene])
+
+    def putScene(self, client, args):
+        self.scenes.save(args['name'], args['commandlist'])
+        return None, 200
+
+    def deleteScene(self, client, args):
+        try:
+            self.scenes.delete(args['name'])
+        except KeyError:
+            return {'message': 'No scene named %s' % args['name']}, 404
+        return None, 200
+
+    def getStats(self, client, args):
+        return self.renderer.stats(), 200
+
+    def getMetrics(self, client, args):
+        return self.renderer.metrics().encode(), 200, METRICS_CONTENT_TYPE
+
+    def getProfile(self, client, args):
+        return self.renderer.profiler.report(), 200
+
+    def putProfile(self, client, args):
+        self.renderer.profiler.start(args['interval'])
+        return None, 200
+
+    def deleteProfile(self, client, args):
+        self.renderer.profiler.stop()
+        return None, 200
+
+    def arguments(self, names, query, body, contentType):
+        '''Convert the named arguments from the query string and body. Returns
+        (args, None), or (None, message) naming the first invalid argument'''
+        values = {}
+        for name, value in urllib.parse.parse_qsl(query.decode('latin-1')):
+            values.setdefault(name, value)
+        if body:
+            if 'json' in contentType:
+                try:
+                    data = json.loads(body)
+                except ValueError:
+                    return None, {'message': 'Request body is not valid JSON'}
+                if isinstance(data, dict):
+                    values.update(data)
+            elif 'x-www-form-urlencoded' in contentType:
+                values.update(urllib.parse.parse_qsl(body.decode('latin-1')))
+        args = {}
+        for name in names:
+            value = values.get(name)
+            if value is not None:
+                convert, help = ASYNC_ARGUMENTS[name]
+                try:
+                    value = convert(value)
+                except (TypeError, ValueError):
+                    return None, {'message': {name: help}}
+            args[name] = value
+        return args, None
+
+    async def dispatch(self, method, path, query, body, contentType, client):
+        '''Run the route for one request, returns (status, content type, payload)'''
+        route = self.routes.get((method, path))
+        if route is None:
+            if any(p == path for m, p in self.routes):
+                return self.encode({'message': 'The method is not allowed for the requested URL.'}, 405)
+            return self.encode({'message': 'The requested URL was not found on the server.'}, 404)
+        handler, names, blocking = route
+        args, error = self.arguments(names, query, body, contentType)
+        if error:
+            return self.encode(error, 400)
+        try:
+            if blocking:
+                response = await asyncio.get_running_loop().run_in_executor(None, handler, client, args)
+            else:
+                response = handler(client, args)
+        except (TypeError, ValueError, IndexError) as e:
+            return self.encode({'message': 'Invalid request: %s' % e}, 400)
+        except Exception:
+            logger.exception('Error serving %s %s', method, path)
+            return self.encode({'message': 'Internal Server Error'}, 500)
+        #Handlers add a content type when the response is not JSON
+        if len(response) == 3:
+            return response[1], response[2], response[0]
+        return self.encode(*response)
+
+    def encode(self, result, status):
+        return status, 'application/json', (json.dumps(result) + '\n').encode()
+
+    async def __call__(self, scope, receive, send):
+        '''ASGI entry point'''
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+        body = b''
+        more = True
+        while more:
+            message = await receive()
+            body += message.get('body', b'')
+            more = message.get('more_body', False)
+        headers = dict(scope.get('headers', ()))
+        client = scope.get('client') or ('127.0.0.1', 0)
+        status, contentType, payload = await self.dispatch(scope['method'], scope['path'], scope.get('query_string', b''),
+                                                           body, headers.get(b'content-type', b'').decode('latin-1'), client[0])
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', contentType.encode()),
+                                (b'content-length', str(len(payload)).encode())]})
+        await send({'type': 'http.response.body', 'body': payload})
+
+    async def connection(self, reader, writer):
+        '''Serve HTTP/1.1 requests from one client connection, keeping it open between requests'''
+        client = writer.get_extra_info('peername')[0]
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    return
+                lines = head.decode('latin-1').split('\r\n')
+                method, target, version = lines[0].split(' ', 2)
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                path, _, query = target.partition('?')
+                status, contentType, payload = await self.dispatch(method, urllib.parse.unquote(path), query.encode('latin-1'),
+                                                                   body, headers.get('content-type', ''), client)
+                connection = headers.get('connection', '').lower()
+                keepAlive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+                writer.write(('HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n%s\r\n'
+                              % (status, http.HTTPStatus(status).phrase, contentType, len(payload),
+                                 '' if keepAlive else 'Connection: close\r\n')).encode('latin-1') + payload)
+                await writer.drain()
+                if not keepAlive:
+                    return
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host, port):
+        '''Start listening, returns the asyncio server'''
+        return await asyncio.start_server(self.connection, host, port)
+
+    def serveForever(self, host, port):
+        async def serve():
+            server = await self.start(host, port)
+            async with server:
+                await server.serve_forever()
+        asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    #########################LOAD IN USER CONFIG####################################
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opcConfig.yml')) as f:
+        configFile = f.read()
+    configs = yaml.safe_load(configFile)
+
+
+    ##################SERVER LOGGING AND REPORTING FUNCTIONS########################
+    logListener = startLogging()
+    logger.info('Server booted at ' + str(datetime.datetime.now()))
+
+    #PSUs may be a single relay or a list of relays each powering a range of pixels
+    psuConfigs = configs['PSUs']
+    if isinstance(psuConfigs, dict):
+        psuConfigs = [psuConfigs]
+    psus = [PSU(p['ip'], p['index'], port=p['port'], debounce=p.get('debounce', 2),
+                pixels=p.get('pixels')) for p in psuConfigs]
+    colorConfig = configs.get('color')
+    correction = None
+    if colorConfig:
+        correction = ColorCorrection(gamma=colorConfig.get('gamma', 1.0),
+                                     whitePoint=colorConfig.get('whitepoint'),
+                                     dither=colorConfig.get('dither', False),
+                                     settleFrames=colorConfig.get('settle', 32))
+    renderer = Renderer(configs['framerate'], PSU=psus,
+                        pixelCount=configs.get('pixels', 512),
+                        channels=configs.get('channels'),
+                        keepAlive=configs.get('keepalive'),
+                        outputs=configs.get('opc'),
+                        minFrameRate=configs.get('minframerate'),
+                        correction=correction)
+    scenes = SceneLibrary(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opcScenes.yml'),
+                          renderer.pixelCount)
+
+
+    localIP = getLocalIP()
+    port = 8000
+    if configs.get('server') == 'async':
+        server = AsyncServer(renderer, scenes)
+    else:
+        flaskServer = createFlaskServer(renderer, scenes)
+
+    for psu in psus:
+        psu.switch(True)
+    for psu in psus:
+        psu.wait(3)
 
     #Test pattern to indicate server is up and running
-    testPatternOff = np.zeros((512, 3))
-    testPatternRed = np.full((512, 3), [64,0,0])
+    testPatternOff = np.zeros((renderer.pixelCount, 3), dtype=np.uint8)
+    testPatternRed = np.full((renderer.pixelCount, 3), [64,0,0], dtype=np.uint8)
 
-    renderer.opcClient.put_pixels(testPatternRed)
-    renderer.opcClient.put_pixels(testPatternRed)
+    renderer.sendFrame(testPatternRed)
     time.sleep(.5)
-    renderer.opcClient.put_pixels(testPatternOff)
-    renderer.opcClient.put_pixels(testPatternOff)
+    renderer.sendFrame(testPatternOff)
     time.sleep(.5)
-    renderer.opcClient.put_pixels(testPatternRed)
-    renderer.opcClient.put_pixels(testPatternRed)
+    renderer.sendFrame(testPatternRed)
     time.sleep(.5)
-    renderer.opcClient.put_pixels(testPatternOff)
-    renderer.opcClient.put_pixels(testPatternOff)
+    renderer.sendFrame(testPatternOff)
     del testPatternOff
     del testPatternRed
 
 
     renderer.renderLoop.start()
-    flaskServer.run(host=localIP, port=port, debug=False)
+    if configs.get('streamport'):
+        streamServer = StreamServer((localIP, configs['streamport']), renderer)
+        streamThread = threading.Thread(target=streamServer.serve_forever)
+        streamThread.daemon = True
+        streamThread.start()
+        logger.info('Streaming on port %d', configs['streamport'])
+    try:
+        if configs.get('server') == 'async':
+            logger.info('Serving REST API from asyncio')
+            server.serveForever(localIP, port)
+        else:
+            flaskServer.run(host=localIP, port=port, debug=False)
+    finally:
+        stopLogging(logListener)
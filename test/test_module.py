@@ -1,4 +1,10 @@
+import json
+import threading
+import http.server
+import socketserver
+import opc
 import opcBridge
+import benchmark
 
 def test_makeEightBit():
     assert opcBridge.makeEightBit(3666) == 255
@@ -27,7 +33,810 @@ def test_renderer():
     renderer.commands.put([renderer.relativeFade, [12, [0], 5]])
     renderer.commands.put([renderer.absoluteFade, [[255,255,255], [1], 0]])
     renderer.commands.put([renderer.multiCommand, [[[[2], [128,128,128], 2]]]])
-    renderer.executeCommands()
-    assert renderer.remaining[0] == 5 * renderer.frameRate
+    renderer.executeCommands(10)
+    assert renderer.fadeEnd[0] == 15 and renderer.fadeStart[0] == 10
     assert renderer.endVals[1][0] == 255
-    assert renderer.remaining[1] == 2
+    assert renderer.fadeEnd[1] == 10
+    assert renderer.fadeEnd[2] == 12
+
+def test_interpolate():
+    '''Linear fades step evenly and land exactly on their end value'''
+    renderer = opcBridge.Renderer(16, pixelCount=4)
+    renderer.pixels[:] = 100
+    renderer.fadeTo([0, 1], [[200, 0, 50], [100, 100, 100]], 1, now=0)
+    values = []
+    for now in (0.25, 0.5, 0.75, 1):
+        assert renderer.interpolate(now)
+        values.append(renderer.pixels[0].tolist())
+    assert values == [[125, 75, 87.5], [150, 50, 75], [175, 25, 62.5], [200, 0, 50]]
+    assert renderer.pixels[1].tolist() == [100, 100, 100]
+    assert not renderer.interpolate(1.25)
+
+def test_fadeTiming():
+    '''Fades end on time however many frames are rendered on the way'''
+    renderer = opcBridge.Renderer(16, pixelCount=4)
+    renderer.fadeTo([0], [160, 0, 0], 2, now=0)
+    renderer.interpolate(0.5)
+    assert renderer.pixels[0, 0] == 40
+    #A single late frame lands exactly where it should
+    renderer.interpolate(1.5)
+    assert renderer.pixels[0, 0] == 120
+    renderer.interpolate(2.5)
+    assert renderer.pixels[0, 0] == 160 and not renderer.fading.any()
+    #A new fade starts from the value the old one has reached at that moment
+    renderer.fadeTo([1], [100, 0, 0], 1, now=3)
+    renderer.interpolate(3.5)
+    renderer.fadeTo([1], [0, 0, 0], 1, now=3.5)
+    assert renderer.startVals[1, 0] == 50
+    renderer.interpolate(3.75)
+    assert renderer.pixels[1, 0] == 37.5
+    #Relative fades during a fade adjust where it ends, sent twice they add up
+    renderer.fadeTo([2], [100, 100, 100], 1, now=4)
+    renderer.interpolate(4.5)
+    renderer.relativeFade(20, [2], 1)
+    renderer.relativeFade(20, [2], 1)
+    assert renderer.endVals[2].tolist() == [140, 140, 140]
+    #Zero length fades land on the next frame
+    renderer.absoluteFade([9, 9, 9], [3], 0)
+    renderer.interpolate()
+    assert renderer.pixels[3].tolist() == [9, 9, 9]
+
+def test_curves():
+    renderer = opcBridge.Renderer(16, pixelCount=len(opcBridge.CURVES))
+    for curve in opcBridge.CURVES:
+        renderer.fadeTo([opcBridge.CURVES.index(curve)], [255, 255, 255], 1, curve, now=0)
+    renderer.interpolate(0.5)
+    halfway = renderer.pixels[:, 0].tolist()
+    renderer.interpolate(1)
+    linear, easeInOut, exponential, perceptual = halfway
+    assert linear == 127.5
+    assert abs(easeInOut - 127.5) < 0.01
+    assert exponential < 10
+    #Perceptual fades spend longer at low brightness: half way is about 255 * 0.5 ** 2.2
+    assert abs(perceptual - 55.5) < 1
+    assert (renderer.pixels == 255).all()
+    try:
+        renderer.absoluteFade([1, 1, 1], [0], 1, 'bouncy')
+        assert False
+    except ValueError:
+        pass
+
+def test_channelMap():
+    client = opc.Client('127.0.0.1:7890', channel_map={1: [0, 64], 2: [64, 64]})
+    assert client._single_message(128)
+    assert not client._single_message(100)
+    gappy = opc.Client('127.0.0.1:7890', channel_map={1: [0, 64], 2: [128, 64]})
+    assert not gappy._single_message(192)
+    big = opc.Client('127.0.0.1:7890', channel_map={c: [(c - 1) * 64, 64] for c in range(1, 513)})
+    assert not big._single_message(512 * 64)
+    message = client._build_message(2, [(1, 2, 3)])
+    assert message == bytes([2, 0, 0, 3, 1, 2, 3])
+    #Frames too big for one message need a channel map, checked up front
+    opc.Client('127.0.0.1:7890', channel_map={1: [0, 20000], 2: [20000, 10000]}).check_frame(30000)
+    try:
+        opc.Client('127.0.0.1:7890').check_frame(opc.MAX_PIXELS_PER_MESSAGE + 1)
+        assert False
+    except ValueError:
+        pass
+    try:
+        opcBridge.Renderer(16, pixelCount=30000)
+        assert False
+    except ValueError:
+        pass
+    opcBridge.Renderer(16, pixelCount=30000, outputs=[{'server': '127.0.0.1:7890', 'pixels': [0, 20000]},
+                                                       {'server': '127.0.0.1:7891', 'pixels': [20000, None]}])
+
+def test_rendererSize():
+    renderer = opcBridge.Renderer(16, pixelCount=4096)
+    assert renderer.pixels.shape == (4096, 3)
+    renderer.absoluteFade([255, 0, 0], [4095], 0)
+    assert renderer.endVals[4095][0] == 255
+
+def test_encodeArray():
+    '''numpy fast path must produce the same bytes as the tuple list path'''
+    rng = opcBridge.np.random.default_rng(2)
+    frame = rng.uniform(0, 255, (128, 3)).astype('float32')
+    for channelMap in (None, {1: [0, 64], 2: [64, 64]}, {2: [64, 64], 1: [0, 32]}):
+        client = opc.Client('127.0.0.1:7890', channel_map=channelMap)
+        assert bytes(client._encode(frame)) == bytes(client._encode(frame.tolist()))
+    clamped = opc.Client('127.0.0.1:7890')._encode(opcBridge.np.array([[-3.0, 300.0, 7.9]]))
+    assert bytes(clamped) == bytes([0, 0, 0, 3, 0, 255, 7])
+
+def test_brightnessChangeArray():
+    rgb = opcBridge.np.array([[128, 128, 128], [50, 25, 0], [0, 0, 0], [200, 100, 50]], dtype='float32')
+    for magnitude in (0, 255, -128, 12.5, -199.5):
+        out = opcBridge.brightnessChangeArray(rgb, magnitude)
+        for row, expected in zip(out, rgb):
+            assert list(row) == [float(v) for v in opcBridge.brightnessChange(expected, magnitude)]
+
+def test_batchCommands():
+    '''Vectorized commands must match the original per index loops'''
+    renderer = opcBridge.Renderer(16)
+    rng = opcBridge.np.random.default_rng(3)
+    renderer.pixels[:] = rng.uniform(0, 255, (512, 3)).astype('float32')
+    commandList = [[[0, 1, 2], [255, 0, 10], 1.5], [[2, 300], [5.5, 6, 7], 0, 'easeinout'], [list(range(400, 512)), [9, 9, 9], 3]]
+    expectedStart = renderer.startVals.copy()
+    expectedEnd = renderer.endVals.copy()
+    expectedTimes = opcBridge.np.zeros(512)
+    expectedCurves = renderer.curves.copy()
+    for command in commandList:
+        indexes, rgb, fadeTime = command[:3]
+        for i in indexes:
+            expectedTimes[i] = fadeTime
+            expectedStart[i] = renderer.pixels[i]
+            expectedEnd[i] = rgb
+            expectedCurves[i] = opcBridge.CURVES.index(command[3]) if len(command) > 3 else 0
+    renderer.multiCommand(commandList)
+    assert renderer.startVals.tobytes() == expectedStart.tobytes()
+    assert renderer.endVals.tobytes() == expectedEnd.tobytes()
+    assert (renderer.fading == (expectedEnd != 0).any(axis=1)).all()
+    fading = renderer.fading
+    assert (renderer.fadeEnd[fading] - renderer.fadeStart[fading] == expectedTimes[fading]).all()
+    assert (renderer.curves == expectedCurves).all()
+
+    renderer.relativeFade(-40, [5, 6, 7], 2)
+    for i in (5, 6, 7):
+        expected = opcBridge.brightnessChange(renderer.pixels[i], -40)
+        assert list(renderer.endVals[i]) == [float(v) for v in expected]
+        assert renderer.fadeEnd[i] - renderer.fadeStart[i] == 2
+
+def test_frameClock():
+    clock = opcBridge.FrameClock(100)
+    clock.reset()
+    assert clock.wait() == 1
+    #Fall three and a half frames behind: the missed frames are merged into the next one
+    clock.deadline = opcBridge.time.perf_counter() - 0.035
+    assert clock.wait() == 4
+    assert clock.late == 1
+    #Fall further behind than maxMerge: the backlog is dropped
+    clock.deadline = opcBridge.time.perf_counter() - 5
+    assert clock.wait() == 1
+    assert clock.dropped >= 500
+    for i in range(10):
+        clock.record(i * 0.01, 0.002)
+    stats = clock.stats()
+    assert round(stats['fps']) == 100
+    assert stats['p50ms'] == 2
+    assert stats['frames'] == 10
+    #Given a minimum framerate, slow frames stretch the interval and quick ones shrink it back
+    clock = opcBridge.FrameClock(100, minFrameRate=25)
+    for i in range(20):
+        clock.record(i, 0.05)
+    assert clock.interval == 0.04 and clock.stats()['renderfps'] == 25
+    assert clock.steps(1) == 4
+    clock.interval = 0.0125
+    assert [clock.steps(1) for i in range(4)] == [1, 1, 1, 2]
+    for i in range(20):
+        clock.record(i, 0.001)
+    assert clock.interval == 0.01
+
+def test_coalescing():
+    '''Commands merged into one batch must end up the same as applying them one by one'''
+    batched = opcBridge.Renderer(16)
+    sequential = opcBridge.Renderer(16)
+    commands = [('absoluteFade', [[255, 0, 0], [0, 1, 2, 3], 1]),
+                ('relativeFade', [-20, [2, 3, 4], 2]),
+                ('multiCommand', [[[[3, 5], [0, 0, 255], 0.5], [[1], [9, 9, 9], 3]]]),
+                ('absoluteFade', [[1, 2, 3], [5], 4, 'exponential'])]
+    for renderer in (batched, sequential):
+        renderer.pixels[:] = 100
+    for name, args in commands:
+        assert batched.submit(getattr(batched, name), args)
+        #Each command applied on its own, all at the same moment
+        sequential.batching = True
+        getattr(sequential, name)(*args)
+        sequential.applyBatch(7)
+    batched.executeCommands(7)
+    assert batched.startVals.tobytes() == sequential.startVals.tobytes()
+    assert (batched.curves == sequential.curves).all()
+    assert batched.endVals.tobytes() == sequential.endVals.tobytes()
+    assert (batched.fading == sequential.fading).all()
+    assert (batched.fadeEnd == sequential.fadeEnd).all()
+    assert not batched.batchTouched.any()
+
+def test_submitBackPressure():
+    renderer = opcBridge.Renderer(16)
+    for i in range(renderer.commands.maxsize):
+        assert renderer.submit(renderer.absoluteFade, [[1, 1, 1], [0], 0])
+    assert not renderer.submit(renderer.absoluteFade, [[1, 1, 1], [0], 0])
+    assert renderer.clockerActive.is_set()
+
+class RelayHandler(http.server.BaseHTTPRequestHandler):
+    '''Stand-in relay processor, records every switch request it receives'''
+    def do_GET(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append(json.loads(body))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class RelayServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    '''Threaded HTTP server for the stand-in relay processor'''
+    daemon_threads = True
+
+def test_PSURelay():
+    relay = RelayServer(('127.0.0.1', 0), RelayHandler)
+    relay.received = []
+    threading.Thread(target=relay.serve_forever, daemon=True).start()
+    try:
+        psu = opcBridge.PSU('127.0.0.1', 6, port=relay.server_address[1], debounce=0.2)
+        psu.switch(True)
+        assert psu.wait(2)
+        assert relay.received == [{'index': 6, 'state': True}]
+        #A brief dark spell is debounced and never reaches the relay
+        psu.switch(False)
+        psu.switch(True)
+        psu.switch(False)
+        psu.switch(True)
+        opcBridge.time.sleep(0.3)
+        assert relay.received == [{'index': 6, 'state': True}]
+        psu.switch(False)
+        assert psu.wait(2)
+        assert relay.received[-1] == {'index': 6, 'state': False}
+        assert len(relay.received) == 2
+    finally:
+        relay.shutdown()
+
+class RecordingPSU(opcBridge.PSU):
+    '''PSU that records switch requests instead of talking to a relay'''
+    def switch(self, state):
+        self.state = state
+
+def test_litTracking():
+    first = RecordingPSU('127.0.0.1', 1, pixels=[0, 256])
+    second = RecordingPSU('127.0.0.1', 2, pixels=[256, 512])
+    renderer = opcBridge.Renderer(16, PSU=[first, second])
+    renderer.fadeTo([300, 301], [0, 10, 0], 0, now=0)
+    assert renderer.lit.sum() == 2
+    renderer.updatePSUs()
+    assert not first.state and second.state
+    assert renderer.interpolate(0)
+    #Fading to black keeps the pixel lit until the fade completes
+    renderer.fadeTo([300, 301], [0, 0, 0], 1, now=1)
+    renderer.interpolate(1.5)
+    assert renderer.lit.sum() == 2
+    renderer.interpolate(2)
+    assert not renderer.interpolate(2.5)
+    assert not renderer.lit.any()
+    renderer.updatePSUs()
+    assert not first.state and not second.state
+    #PSU=False, the old default, means no PSUs
+    renderer = opcBridge.Renderer(16, PSU=False)
+    assert renderer.PSUs == []
+    renderer.updatePSUs()
+
+def test_encodePixels():
+    renderer = opcBridge.Renderer(16, pixelCount=4)
+    renderer.pixels[:] = [[1.9, 2, 3], [255, 300, -1], [0, 0, 0], [16, 32, 64]]
+    renderer.publishFrame()
+    frame = renderer.snapshot(1, 3)
+    assert opcBridge.encodePixels(frame) == [[255, 255, 0], [0, 0, 0]]
+    assert opcBridge.encodePixels(frame, 'raw') == bytes([255, 255, 0, 0, 0, 0])
+    assert opcBridge.encodePixels(frame, 'hex') == 'ffff00000000'
+    assert opcBridge.encodePixels(frame, 'base64') == '//8AAAAA'
+    assert opcBridge.pixelsToJson(renderer.pixels[:1]) == [[1, 2, 3]]
+    assert not frame.flags.writeable
+
+def test_streamServer():
+    renderer = opcBridge.Renderer(16, channels={1: [0, 64], 2: [64, 64]})
+    server = opcBridge.StreamServer(('127.0.0.1', 0), renderer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = opcBridge.socket.create_connection(server.server_address)
+        client.sendall(opcBridge.streamAbsoluteFade([255, 0, 0], [1, 2, 600], 1))
+        client.sendall(opcBridge.streamRangeFade(10, [[0, 0, 9], [0, 0, 10]], 0))
+        client.sendall(opcBridge.streamRelativeFade(-10, [3], 2))
+        client.sendall(bytes([2, 0, 0, 3, 7, 8, 9]))
+        client.close()
+        for i in range(100):
+            if renderer.commands.qsize() == 4:
+                break
+            opcBridge.time.sleep(0.01)
+        renderer.executeCommands()
+    finally:
+        server.shutdown()
+        server.server_close()
+    fadeTimes = renderer.fadeEnd - renderer.fadeStart
+    assert list(renderer.endVals[1]) == [255, 0, 0]
+    assert fadeTimes[2] == 1
+    assert list(renderer.endVals[11]) == [0, 0, 10]
+    assert fadeTimes[11] == 0
+    assert renderer.fading[3] and fadeTimes[3] == 2
+    assert list(renderer.endVals[64]) == [7, 8, 9]
+
+def test_streamBackPressure():
+    '''With the render queue full, stream messages wait for room instead of being dropped'''
+    renderer = opcBridge.Renderer(16)
+    server = opcBridge.StreamServer(('127.0.0.1', 0), renderer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        while renderer.submit(renderer.absoluteFade, [[1, 1, 1], [0], 0]):
+            pass
+        client = opcBridge.socket.create_connection(server.server_address)
+        client.sendall(opcBridge.streamAbsoluteFade([0, 255, 0], [7], 0))
+        opcBridge.time.sleep(1.2)
+        assert renderer.commands.qsize() == renderer.commands.maxsize
+        renderer.executeCommands()
+        for i in range(100):
+            if renderer.commands.qsize():
+                break
+            opcBridge.time.sleep(0.01)
+        renderer.executeCommands()
+        assert list(renderer.endVals[7]) == [0, 255, 0]
+        client.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_effects():
+    renderer = opcBridge.Renderer(10, pixelCount=32)
+    renderer.absoluteFade([9, 9, 9], list(range(32)), 1)
+    renderer.addEffect('1', opcBridge.Effect('chase', range(10), 10, {'rgb': [255, 0, 0], 'width': 2}))
+    renderer.addEffect('2', opcBridge.Effect('rainbow', range(10, 20), 10))
+    assert not renderer.fading[:20].any() and renderer.fading[20]
+    assert renderer.renderEffects()
+    assert renderer.pixels[:10, 0].tolist() == [255] + [0] * 8 + [255]
+    assert renderer.lit[0] and not renderer.lit[5]
+    assert (renderer.pixels[10:20].max(axis=1) == 255).all()
+    renderer.removeEffect('1')
+    renderer.removeEffect('2')
+    assert not renderer.renderEffects()
+    for name in opcBridge.effects.EFFECTS:
+        frames = opcBridge.effects.create(name, 100, 16)
+        for i in range(20):
+            frame = next(frames)
+        assert frame.shape == (100, 3)
+        assert frame.min() >= 0 and frame.max() <= 255
+    try:
+        opcBridge.Effect('strobe', range(10), 10)
+        assert False
+    except ValueError:
+        pass
+    for name in opcBridge.effects.EFFECTS:
+        assert next(opcBridge.effects.create(name, 0, 16)).shape == (0, 3)
+    try:
+        opcBridge.Effect('chase', [], 10)
+        assert False
+    except ValueError:
+        pass
+    #An effect failing part way through is stopped, the other effects keep running
+    def failing(count, frameRate):
+        yield opcBridge.np.zeros((count, 3))
+        raise RuntimeError('boom')
+    opcBridge.effects.EFFECTS['failing'] = failing
+    try:
+        renderer.addEffect('3', opcBridge.Effect('failing', [0], 10))
+        renderer.addEffect('4', opcBridge.Effect('rainbow', [1], 10))
+        assert renderer.renderEffects()
+        assert renderer.renderEffects()
+        assert list(renderer.effects) == ['4']
+    finally:
+        del opcBridge.effects.EFFECTS['failing']
+
+def test_scenes(tmp_path):
+    path = str(tmp_path / 'opcScenes.yml')
+    renderer = opcBridge.Renderer(16, pixelCount=64)
+    library = opcBridge.SceneLibrary(path, renderer.pixelCount, cacheSize=2)
+    sunset = [[[0, 1, 2], [255, 80, 0], 2, 'perceptual'], [[2, 3], [10, 0, 0], 0]]
+    library.save('sunset', sunset)
+    library.save('off', [[list(range(64)), [0, 0, 0], 1]])
+    library.save('red', [[[5], [255, 0, 0], 1]])
+    assert list(library.compiled) == ['off', 'red']
+    #Reload from disk and recall: same result as sending the multicommand
+    library = opcBridge.SceneLibrary(path, renderer.pixelCount)
+    assert library.names() == ['off', 'red', 'sunset']
+    scene = library.get('sunset')
+    assert scene.indexes.tolist() == [0, 1, 2, 3]
+    assert library.get('sunset') is scene
+    expected = opcBridge.Renderer(16, pixelCount=64)
+    expected.submit(expected.multiCommand, [sunset])
+    expected.executeCommands(5)
+    renderer.submit(renderer.applyScene, [scene])
+    renderer.executeCommands(5)
+    for name in ('endVals', 'fadeStart', 'fadeEnd', 'fading', 'curves'):
+        assert (getattr(renderer, name) == getattr(expected, name)).all()
+    try:
+        library.save('broken', [[[64], [1, 1, 1], 1]])
+        assert False
+    except IndexError:
+        pass
+    for name in (None, '', 5):
+        try:
+            library.save(name, sunset)
+            assert False
+        except TypeError:
+            pass
+    #Both servers answer a scene without a name with 400, and store nothing
+    asyncServer = opcBridge.AsyncServer(renderer, library)
+    status = opcBridge.asyncio.run(asyncServer.dispatch('PUT', '/scenes', b'', b'{"commandlist": [[[1], [1, 1, 1], 0]]}',
+                                                        'application/json', '127.0.0.1'))[0]
+    assert status == 400
+    flask = opcBridge.createFlaskServer(renderer, library).test_client()
+    assert flask.put('/scenes', json={'commandlist': '[[[1], [1, 1, 1], 0]]'}).status_code == 400
+    assert flask.get('/scenes', json={}).get_json() == ['off', 'red', 'sunset']
+    library.delete('red')
+    assert opcBridge.SceneLibrary(path, 64).names() == ['off', 'sunset']
+
+def test_snapshotConsistency():
+    '''Snapshots taken while frames are being published are never torn'''
+    renderer = opcBridge.Renderer(16, pixelCount=20000)
+    running = True
+    def publish():
+        value = 0
+        while running:
+            value = (value + 1) % 256
+            renderer.pixels[:] = value
+            renderer.publishFrame()
+    publisher = threading.Thread(target=publish)
+    publisher.start()
+    try:
+        for i in range(300):
+            frame = renderer.snapshot()
+            assert (frame == frame[0, 0]).all()
+            assert not frame.flags.writeable
+    finally:
+        running = False
+        publisher.join()
+    assert renderer.frameNumber > 0
+    assert renderer.snapshot(5, 7).shape == (2, 3)
+
+class CountingClient:
+    '''Stands in for opc.Client, counts the frames handed to it'''
+    def __init__(self):
+        self.frames = []
+        self.reconnects = 0
+        self.dropped_frames = 0
+        self.encode_time = 0
+        self.send_time = 0
+
+    def put_pixels(self, pixels, channel=0):
+        self.frames.append(bytes(pixels))
+        return True
+
+class SlowClient(CountingClient):
+    '''CountingClient that takes delay seconds per frame, and fails while failing is set'''
+    def __init__(self, delay=0):
+        CountingClient.__init__(self)
+        self.delay = delay
+        self.failing = False
+
+    def put_pixels(self, pixels, channel=0):
+        opcBridge.time.sleep(self.delay)
+        if self.failing:
+            return False
+        return CountingClient.put_pixels(self, pixels, channel)
+
+def test_slowOutput():
+    '''Frames held back while an output is busy are not lost, the newest is sent once it is free'''
+    renderer = opcBridge.Renderer(16, pixelCount=2)
+    client = renderer.outputs[0].client = SlowClient(0.2)
+    renderer.fadeTo([0, 1], [100, 100, 100], 0.1)
+    while renderer.renderFrame():
+        opcBridge.time.sleep(0.05)
+    renderer.flushOutputs()
+    assert renderer.snapshot().tolist() == [[100, 100, 100]] * 2
+    assert client.frames[-1] == bytes([100] * 6)
+    assert renderer.outputs[0].framesBusy > 0
+    #Frames that fail keep the loop rendering until they get through
+    client.delay = 0
+    client.failing = True
+    renderer.fadeTo([0, 1], [5, 5, 5], 0)
+    renderer.renderFrame()
+    renderer.flushOutputs()
+    assert renderer.renderFrame() and renderer.clockerActive.is_set()
+    renderer.flushOutputs()
+    client.failing = False
+    renderer.renderFrame()
+    renderer.flushOutputs()
+    assert not renderer.renderFrame()
+    assert client.frames[-1] == bytes([5] * 6)
+    #A failed frame is retried even when the next frame matches the last one sent
+    client.failing = True
+    renderer.fadeTo([0, 1], [9, 9, 9], 0)
+    renderer.renderFrame()
+    renderer.flushOutputs()
+    client.failing = False
+    sent = len(client.frames)
+    renderer.fadeTo([0, 1], [5, 5, 5], 0)
+    renderer.renderFrame()
+    renderer.flushOutputs()
+    assert not renderer.renderFrame()
+    assert len(client.frames) == sent + 1
+    assert client.frames[-1] == bytes([5] * 6)
+
+def test_sendOnChange():
+    renderer = opcBridge.Renderer(16, pixelCount=8, keepAlive=0.05)
+    client = renderer.outputs[0].client = CountingClient()
+    frame = opcBridge.np.zeros((8, 3), dtype=opcBridge.np.uint8)
+    def send():
+        sent = renderer.sendFrame(frame)
+        renderer.flushOutputs()
+        return sent
+    assert send()
+    assert not send()
+    frame[3] = 9
+    assert send()
+    assert not send()
+    opcBridge.time.sleep(0.06)
+    #Keepalive resends an unchanged frame
+    assert send()
+    assert len(client.frames) == 3
+    stats = renderer.stats()
+    assert stats['framessent'] == 3 and stats['framesskipped'] == 2
+    assert stats['bytessaved'] == 48
+
+class FakeOpcServer:
+    '''Local OPC server that collects every message it receives'''
+    def __init__(self, port=0):
+        self.listener = opcBridge.socket.socket()
+        self.listener.setsockopt(opcBridge.socket.SOL_SOCKET, opcBridge.socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', port))
+        self.listener.listen(4)
+        self.port = self.listener.getsockname()[1]
+        self.messages = []
+        self.connections = []
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                connection, address = self.listener.accept()
+            except OSError:
+                return
+            self.connections.append(connection)
+            threading.Thread(target=self.read, args=(connection,), daemon=True).start()
+
+    def read(self, connection):
+        stream = connection.makefile('rb')
+        try:
+            while True:
+                header = stream.read(4)
+                if len(header) < 4:
+                    return
+                self.messages.append(header + stream.read(header[2] * 256 + header[3]))
+        except OSError:
+            return
+        finally:
+            stream.close()
+
+    def wait(self, count):
+        for i in range(200):
+            if len(self.messages) >= count:
+                return True
+            opcBridge.time.sleep(0.01)
+        return False
+
+    def close(self):
+        #Closing alone leaves the socket listening while accept() is blocked on it
+        try:
+            self.listener.shutdown(opcBridge.socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+        for connection in self.connections:
+            connection.close()
+
+def test_opcReconnect():
+    #A port nothing listens on, from a socket that is bound but never listened on
+    port = opcBridge.socket.socket()
+    port.setsockopt(opcBridge.socket.SOL_SOCKET, opcBridge.socket.SO_REUSEADDR, 1)
+    port.bind(('127.0.0.1', 0))
+    freePort = port.getsockname()[1]
+    port.close()
+    client = opc.Client('127.0.0.1:%d' % freePort, connect_timeout=0.2, max_backoff=0.2)
+    frame = opcBridge.np.full((4, 3), 7, dtype=opcBridge.np.uint8)
+    assert not client.put_pixels(frame)
+    #Backing off: the next frame is dropped without another connection attempt
+    started = opcBridge.time.perf_counter()
+    assert not client.put_pixels(frame)
+    assert opcBridge.time.perf_counter() - started < 0.01
+    assert client.dropped_frames == 2
+    server = FakeOpcServer(freePort)
+    try:
+        opcBridge.time.sleep(0.25)
+        assert client.put_pixels(frame)
+        assert server.wait(1)
+        assert server.messages[0] == bytes([0, 0, 0, 12] + [7] * 12)
+        assert client._socket.getsockopt(opcBridge.socket.IPPROTO_TCP, opcBridge.socket.TCP_NODELAY)
+        #Server goes away: frames are dropped, then the client reconnects
+        for connection in server.connections:
+            connection.shutdown(opcBridge.socket.SHUT_RDWR)
+            connection.close()
+        for i in range(50):
+            if not client.put_pixels(frame):
+                break
+            opcBridge.time.sleep(0.01)
+        opcBridge.time.sleep(0.25)
+        assert client.put_pixels(frame)
+        assert client.reconnects == 1
+    finally:
+        server.close()
+        client.disconnect()
+
+def test_fanOut():
+    servers = [FakeOpcServer(), FakeOpcServer()]
+    outputs = [{'server': '127.0.0.1:%d' % servers[0].port, 'pixels': [0, 4]},
+               {'server': '127.0.0.1:%d' % servers[1].port, 'pixels': [4, 10], 'channels': {2: [0, 2], 1: [2, 4]}}]
+    renderer = opcBridge.Renderer(16, pixelCount=10, outputs=outputs)
+    try:
+        renderer.pixels[:] = opcBridge.np.arange(10)[:, None]
+        renderer.publishFrame()
+        assert renderer.sendFrame(renderer.front) == 2
+        renderer.flushOutputs()
+        assert servers[0].wait(1) and servers[1].wait(2)
+        assert servers[0].messages == [bytes([0, 0, 0, 12]) + bytes(sum([[i] * 3 for i in range(4)], []))]
+        assert servers[1].messages == [bytes([1, 0, 0, 12]) + bytes(sum([[i] * 3 for i in range(6, 10)], [])),
+                                       bytes([2, 0, 0, 6, 4, 4, 4, 5, 5, 5])]
+        assert renderer.channelOffset(1) == 6
+    finally:
+        for output in renderer.outputs:
+            output.client.disconnect()
+        for server in servers:
+            server.close()
+
+def test_asyncServer():
+    renderer = opcBridge.Renderer(16, pixelCount=32)
+    server = opcBridge.AsyncServer(renderer, None)
+    loop = opcBridge.asyncio.new_event_loop()
+    listener = loop.run_until_complete(server.start('127.0.0.1', 0))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d' % listener.sockets[0].getsockname()[1]
+    session = opcBridge.requests.Session()
+    try:
+        response = session.get(url + '/absolutefade', params={'rgb': '[255, 0, 0]', 'indexes': '[1, 2]', 'fadetime': 1})
+        assert response.status_code == 200 and response.json() is None
+        #JSON bodies may carry lists directly, or JSON encoded as the Flask server expects
+        response = session.get(url + '/relativefade', json={'magnitude': -10, 'indexes': '[3]', 'fadetime': 0})
+        assert response.status_code == 200
+        assert session.get(url + '/absolutefade', params={'rgb': '[1, 2, 3]', 'indexes': '[1]', 'fadetime': 'x'}).json() == \
+            {'message': {'fadetime': 'How long will this fade take?'}}
+        assert session.get(url + '/absolutefade', params={'rgb': '[1, 2, 3]', 'indexes': '[32]'}).status_code == 400
+        assert session.get(url + '/multicommand', params={'commandlist': '[[[4], [0, 0, 9], 0, "easeinout"]]'}).status_code == 200
+        assert session.put(url + '/arbitration', params={'id': 'a'}).status_code == 200
+        assert session.get(url + '/arbitration', params={'id': 'a'}).json() is True
+        assert session.get(url + '/arbitration', params={'id': 'b'}).json() is False
+        assert session.get(url + '/nowhere').status_code == 404
+        #Unexpected errors are answered with 500, the connection keeps serving
+        getStats = renderer.stats
+        renderer.stats = lambda: 1 / 0
+        response = session.get(url + '/stats')
+        renderer.stats = getStats
+        assert response.status_code == 500 and 'message' in response.json()
+        assert session.put(url + '/effects', json={'effect': 'chase', 'indexes': []}).status_code == 400
+        assert session.delete(url + '/absolutefade').status_code == 405
+        assert session.get(url + '/pixels', params={'format': 'raw', 'stop': 2}).content == bytes(6)
+        response = session.get(url + '/metrics')
+        assert response.headers['Content-Type'].startswith('text/plain') and 'opcbridge_queue_depth 3' in response.text
+    finally:
+        session.close()
+        async def stop():
+            listener.close()
+            tasks = opcBridge.asyncio.all_tasks() - {opcBridge.asyncio.current_task()}
+            for task in tasks:
+                task.cancel()
+            await opcBridge.asyncio.gather(*tasks, return_exceptions=True)
+        opcBridge.asyncio.run_coroutine_threadsafe(stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+    assert renderer.commands.qsize() == 3
+    renderer.executeCommands(0)
+    assert list(renderer.endVals[1]) == [255, 0, 0] and renderer.fadeEnd[1] == 1
+    assert list(renderer.endVals[4]) == [0, 0, 9] and renderer.curves[4] == opcBridge.CURVES.index('easeinout')
+
+    #The same server as an ASGI application
+    sent = []
+    async def receive():
+        return {'type': 'http.request', 'body': b'{"stop": 1}'}
+    async def send(message):
+        sent.append(message)
+    scope = {'type': 'http', 'method': 'GET', 'path': '/pixels', 'query_string': b'',
+             'headers': [(b'content-type', b'application/json')], 'client': ('127.0.0.1', 1)}
+    opcBridge.asyncio.run(server(scope, receive, send))
+    assert sent[0]['status'] == 200 and json.loads(sent[1]['body']) == [[0, 0, 0]]
+
+def test_flaskServer():
+    renderer = opcBridge.Renderer(16, pixelCount=32)
+    client = opcBridge.createFlaskServer(renderer, None).test_client()
+    assert client.get('/absolutefade', json={'rgb': '[1, 2, 3]', 'indexes': '[1]', 'fadetime': 0}).status_code == 200
+    assert client.get('/pixels', json={'stop': 1}).get_json() == [[0, 0, 0]]
+    assert client.put('/effects', json={'effect': 'chase', 'indexes': '[]'}).status_code == 400
+    assert renderer.commands.qsize() == 1
+
+def test_metrics():
+    renderer = opcBridge.Renderer(16, pixelCount=8)
+    renderer.outputs[0].client = CountingClient()
+    assert not renderer.renderFrame(now=0)
+    renderer.flushOutputs()
+    renderer.submit(renderer.absoluteFade, [[255, 255, 255], [0, 1], 1])
+    renderer.submit(renderer.relativeFade, [10, [5], 1])
+    assert renderer.stats()['queuedepth'] == 2
+    assert renderer.renderFrame(now=0.5)
+    renderer.flushOutputs()
+    renderer.renderFrame(now=1)
+    renderer.flushOutputs()
+    stats = renderer.stats()
+    assert stats['commands'] == 2 and stats['queuedepth'] == 0
+    assert stats['fadesinflight'] == 3
+    assert stats['commandspersec'] > 0
+    assert set(stats['phases']) == set(opcBridge.RENDER_PHASES)
+    metrics = renderer.metrics()
+    assert 'opcbridge_commands_total 2\n' in metrics
+    assert '# TYPE opcbridge_fades_in_flight gauge' in metrics
+    assert 'opcbridge_phase_seconds_count{phase="interpolate"} 3' in metrics
+    #Fades start from where the pixels are, so the second frame was unchanged and not sent
+    assert 'opcbridge_phase_seconds_count{phase="encode"} 2' in metrics
+
+def test_samplingProfiler():
+    profiler = opcBridge.SamplingProfiler(threading.current_thread(), interval=0.001)
+    def busy():
+        end = opcBridge.time.perf_counter() + 0.1
+        while opcBridge.time.perf_counter() < end:
+            pass
+    profiler.start()
+    busy()
+    profiler.stop()
+    report = profiler.report()
+    assert not report['running'] and report['samples'] > 10
+    assert report['stacks'][0]['stack'].endswith('test_module.py:busy')
+
+def test_logging(tmp_path):
+    path = tmp_path / 'log.txt'
+    listener = opcBridge.startLogging(str(path))
+    opcBridge.logError('Command failed! boom')
+    opcBridge.stopLogging(listener)
+    assert 'ERROR Command failed! boom' in path.read_text()
+    assert not opcBridge.logger.handlers
+
+def test_replay(tmp_path):
+    traces = [makeTrace(pixelCount=64, frames=40) for makeTrace in benchmark.TRACES]
+    latencies, sink = benchmark.replay(traces[2])
+    assert len(latencies) == 40
+    #Every frame of the first scene's fade differs from the last, so all are sent
+    assert sink.frames == 40 and sink.bytes == 40 * (4 + 64 * 3)
+    results = benchmark.benchReplay(traces)
+    assert set(results) == {'fullstrip', 'relativefades', 'mixedscenes'}
+    assert results['fullstrip']['fps'] > 0 and results['fullstrip']['peakmb'] > 0
+    path = str(tmp_path / 'results.json')
+    benchmark.saveResults(results, path)
+    benchmark.compareResults(results, path)
+
+def test_colorCorrection():
+    correction = opcBridge.ColorCorrection(gamma=2.2, whitePoint=[1, 0.5, 1])
+    pixels = opcBridge.np.array([[255, 255, 255], [128, 128, 128], [0, 0, 0], [300, -5, 20]], dtype='float32')
+    expected = 255 * opcBridge.np.array([1, 0.5, 1]) * (opcBridge.np.clip(pixels, 0, 255) / 255) ** 2.2
+    assert (correction.apply(pixels) == opcBridge.np.rint(expected)).all()
+    assert not correction.active
+    #Dithered, a value between two levels averages out to it over a few frames
+    dithered = opcBridge.ColorCorrection(gamma=2.2, dither=True, settleFrames=100)
+    pixels = opcBridge.np.array([[10, 20, 40], [255, 0, 128]], dtype='float32')
+    target = 255 * (pixels / 255) ** 2.2
+    total = sum(dithered.apply(pixels).astype(float) for i in range(64))
+    assert opcBridge.np.allclose(total / 64, target, atol=1 / 32)
+    assert dithered.active
+    #Whole levels are sent as they are, and do not keep the render loop awake
+    plain = opcBridge.ColorCorrection(dither=True)
+    assert (plain.apply(pixels) == pixels).all() and not plain.active
+
+def test_correctedOutput():
+    renderer = opcBridge.Renderer(16, pixelCount=4, correction=opcBridge.ColorCorrection(gamma=2.2, dither=True))
+    client = renderer.outputs[0].client = CountingClient()
+    renderer.fadeTo([0, 1], [20, 20, 20], 0, now=0)
+    #Nothing is fading after the first frame, but dithering keeps frames coming
+    assert renderer.renderFrame(now=0)
+    renderer.flushOutputs()
+    assert renderer.renderFrame(now=1)
+    renderer.flushOutputs()
+    assert renderer.snapshot()[0].tolist() == [20, 20, 20]
+    assert client.frames[0] != client.frames[1]
+    assert max(client.frames[0] + client.frames[1]) <= 1
+    #Once the pixels have held still long enough they are rounded and the loop can sleep
+    for i in range(renderer.correction.settleFrames):
+        renderer.renderFrame(now=1)
+    renderer.flushOutputs()
+    assert not renderer.renderFrame(now=1)
+    assert client.frames[-1] == bytes([1] * 6 + [0] * 6)
+    renderer.fadeTo([0, 1], [0, 0, 0], 0, now=2)
+    renderer.renderFrame(now=2)
+    assert not renderer.renderFrame(now=3)